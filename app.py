@@ -3,6 +3,7 @@ from typing import Dict, Any
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 
@@ -14,8 +15,9 @@ load_dotenv()
 executor = PipelineExecutor()
 
 class SourceManager:
+    # Runs can take hours, the routes call these in the threadpool so the event loop keeps serving
     @staticmethod
-    async def register(data: Dict[Any, Any]):
+    def register(data: Dict[Any, Any]):
         try:
             executor.execute_first_time(data)
             return {"status": "Source registerd successfully"}
@@ -26,7 +28,29 @@ class SourceManager:
             )
 
     @staticmethod
-    async def delete(data: Dict[Any, Any]):
+    def profile(data: Dict[Any, Any]):
+        try:
+            executor.profile_job(data)
+            return {"status": "Source profiled successfully"}
+        except Exception as e:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Failed to profile source: {str(e)}"
+            )
+
+    @staticmethod
+    def rebuild(data: Dict[Any, Any]):
+        try:
+            executor.rebuild_job(data)
+            return {"status": "Source rebuilt successfully"}
+        except Exception as e:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Failed to rebuild source: {str(e)}"
+            )
+
+    @staticmethod
+    def delete(data: Dict[Any, Any]):
         try:
             executor.delete_job(data)
             return {"status": "Source deleted successfully"}
@@ -40,6 +64,8 @@ class SourceManager:
 async def lifespan(app: FastAPI):
     scheduler = BackgroundScheduler()
     scheduler.add_job(executor.run_scheduled_jobs, "interval", minutes=1)
+    if executor.work_queue:
+        scheduler.add_job(executor.process_tasks, "interval", seconds=10)
     scheduler.start()
     yield
 
@@ -61,12 +87,22 @@ app = create_app()
 @app.post("/register/source")
 async def register_source(request: Request):
     data = await request.json()
-    return await SourceManager.register(data)
+    return await run_in_threadpool(SourceManager.register, data)
+
+@app.post("/profile/source")
+async def profile_source(request: Request):
+    data = await request.json()
+    return await run_in_threadpool(SourceManager.profile, data)
+
+@app.post("/rebuild/source")
+async def rebuild_source(request: Request):
+    data = await request.json()
+    return await run_in_threadpool(SourceManager.rebuild, data)
 
 @app.post("/delete/source")
 async def delete_source(request: Request):
     data = await request.json()
-    return await SourceManager.delete(data)
+    return await run_in_threadpool(SourceManager.delete, data)
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8182)
@@ -1,6 +1,5 @@
 from pathlib import Path
 
-import json
 from pymongo import UpdateOne
 from unstructured_ingest.utils.data_prep import batch_generator
 from unstructured_ingest.v2.logger import logger
@@ -12,6 +11,8 @@ from unstructured_ingest.v2.processes.connectors.mongodb import MongoDBUploader
 
 from unstructured_ingest.v2.interfaces import FileData
 
+from util.artifacts import load_elements
+
 
 class CustomMongoDBUploader(MongoDBUploader):
     """
@@ -32,8 +33,7 @@ class CustomMongoDBUploader(MongoDBUploader):
     """
 
     def run(self, path: Path, file_data: FileData, **kwargs: Any) -> None:
-        with path.open("r") as file:
-            elements_dict = json.load(file)
+        elements_dict = load_elements(path)
         logger.info(
             f"Writing {len(elements_dict)} objects to destination "
             f"db: {self.connection_config.database}, "
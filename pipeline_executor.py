@@ -1,13 +1,17 @@
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import Dict, Any
+import socket
+import uuid
 from pymongo import MongoClient
 from pymongo.errors import PyMongoError
 import certifi
 import os
 from dotenv import load_dotenv
 from functools import lru_cache
-from util.builder import start_pipeline
+from unstructured_ingest.v2.logger import logger
 from util.base_configs import Config
+from util.work_queue import WorkQueue, lease_heartbeat
 
 load_dotenv()
 
@@ -25,21 +29,99 @@ class MongoDBConnection:
         except PyMongoError as e:
             raise ConnectionError(f"Error connecting to MongoDB: {e}") from e
 
+    @staticmethod
+    @lru_cache(1)
+    def get_task_collection():
+        """Get the work queue collection, stored next to the jobs collection."""
+        collection = MongoDBConnection.get_collection()
+        name = os.getenv("MONGODB_TASK_COLLECTION", f"{collection.name}_tasks")
+        return collection.database[name]
+
 class PipelineExecutor:
     DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+    # A running job renews its lease every LEASE_SECONDS / 3. A job whose lease
+    # expired was interrupted and is reclaimed by the next scheduled run.
+    LEASE_SECONDS = 300
+    
+    # Number of per-file tasks a replica claims and runs through one pipeline
+    TASK_BATCH_SIZE = 10
     
     def __init__(self):
         self.collection = MongoDBConnection.get_collection()
+        # With the work queue enabled, a run only indexes its source and queues
+        # one task per file, which any replica can pick up.
+        self.work_queue = None
+        if os.getenv("WORK_QUEUE_ENABLED", "false").lower() == "true":
+            self.work_queue = WorkQueue(MongoDBConnection.get_task_collection())
+            self.work_queue.create_indexes()
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    
+    @staticmethod
+    def _builder():
+        """
+        util.builder, imported when the first pipeline runs. It loads unstructured's
+        pipeline, processing modules and connectors, which the API does not need
+        to start.
+        """
+        from util import builder
+        return builder
+    
+    def _lease_expiry(self) -> str:
+        return (datetime.now() + timedelta(seconds=self.LEASE_SECONDS)).strftime(self.DATE_FORMAT)
+    
+    def _lease_expired(self, entry: Dict[str, Any]) -> bool:
+        """Check if a running entry's lease has lapsed. Entries without a lease predate leasing."""
+        if not entry.get("lease_expires_at"):
+            return True
+        return datetime.strptime(entry["lease_expires_at"], self.DATE_FORMAT) < datetime.now()
     
     def _update_entry_status(self, entry_id: str, status: str, last_run: datetime = None) -> None:
-        """Update the status and optionally the last_run time of an entry."""
+        """Update the status and optionally the last_run time of an entry, releasing its lease."""
         update_data = {"status": status}
+        if status == "failed":
+            # Failed entries aren't resumed, their checkpoints would never be cleaned up
+            self._builder().remove_job_work_dir(str(entry_id))
         if last_run:
             update_data["last_run"] = last_run.strftime(self.DATE_FORMAT)
-        self.collection.update_one({"_id": entry_id}, {"$set": update_data})
+        self.collection.update_one(
+            {"_id": entry_id},
+            {"$set": update_data, "$unset": {"lease_expires_at": "", "backfill": ""}}
+        )
+    
+    def _claim_entry(self, entry: Dict[str, Any], backfill: bool = False) -> bool:
+        """
+        Atomically mark an entry as running, unless another run claimed it first.
+        A backfill is recorded on the entry so that an interrupted one resumes as such.
+        """
+        update_data = {"status": "running", "lease_expires_at": self._lease_expiry()}
+        if backfill:
+            update_data["backfill"] = True
+        result = self.collection.update_one(
+            {
+                "_id": entry["_id"],
+                "status": entry["status"],
+                "lease_expires_at": entry.get("lease_expires_at"),
+            },
+            {"$set": update_data}
+        )
+        return result.modified_count == 1
+    
+    @contextmanager
+    def _hold_lease(self, entry_id: Any):
+        """Keep renewing the lease of a running entry until the block exits."""
+        def renew():
+            self.collection.update_one(
+                {"_id": entry_id, "status": "running"},
+                {"$set": {"lease_expires_at": self._lease_expiry()}}
+            )
+        
+        with lease_heartbeat(renew, self.LEASE_SECONDS / 3):
+            yield
     
     def _should_run_pipeline(self, entry: Dict[str, Any]) -> bool:
         """Check if pipeline should run based on entry conditions."""
+        if entry["status"] == "running":
+            return self._lease_expired(entry)
         if entry["status"] != "completed":
             return False
         
@@ -49,39 +131,214 @@ class PipelineExecutor:
     
     def run_scheduled_jobs(self) -> None:
         """Execute scheduled pipeline jobs."""
+        if self.work_queue:
+            self._finalize_queued_runs()
         for entry in self.collection.find({}):
             if not self._should_run_pipeline(entry):
                 continue
                 
             self._execute_pipeline(entry)
     
-    def _execute_pipeline(self, entry: Dict[str, Any]) -> None:
-        """Execute a single pipeline."""
+    def _execute_pipeline(self, entry: Dict[str, Any], profile: bool = False, backfill: bool = False) -> bool:
+        """
+        Execute a single pipeline, resuming from checkpoints if it was interrupted.
+        Returns False if another run claimed the entry first.
+        """
+        resume = entry["status"] == "running"
+        backfill = backfill or (resume and entry.get("backfill", False))
+        if not self._claim_entry(entry, backfill):
+            return False
         try:
-            self._update_entry_status(entry["_id"], "running")
             config = Config(**entry)
-            start_pipeline(config)
+            config.profile = profile
+            with self._hold_lease(entry["_id"]):
+                if self.work_queue:
+                    self._enqueue_run(entry["_id"], config, backfill)
+                    return True
+                self._builder().start_pipeline(
+                    config, job_id=str(entry["_id"]), resume=resume, backfill=backfill)
             self._update_entry_status(entry["_id"], "completed", datetime.now())
         except Exception as e:
             self._update_entry_status(entry["_id"], "failed")
             raise RuntimeError(f"Pipeline execution failed: {e}") from e
+        return True
     
+    def _check_profile(self, profile: bool) -> None:
+        """Profiles cover one process, a queued run is spread over every replica's."""
+        if profile and self.work_queue:
+            raise ValueError("Profiling is not available with the work queue enabled, "
+                             "runs are split across replicas")
+
+    def _check_backfill_target(self, config: Config, backfill: bool, entry_id: Any = None) -> None:
+        """
+        A backfill swaps its shadow collection in for the whole destination
+        collection, dropping what other sources loaded into it. Refuse a
+        backfill of a shared collection, and new sources of a collection
+        that is being backfilled.
+        """
+        target = f"{config.destination.database}.{config.destination.collection}"
+        query = {
+            "_id": {"$ne": entry_id},
+            "destination.database": config.destination.database,
+            "destination.collection": config.destination.collection,
+        }
+        if not backfill:
+            query["backfill"] = True
+        other = self.collection.find_one(query, {"_id": 1})
+        if other and backfill:
+            raise ValueError(f"Source {other['_id']} also loads into {target}, a backfill would remove its chunks")
+        if other:
+            raise ValueError(f"Source {other['_id']} is backfilling {target}")
+
     def execute_first_time(self, data: Dict[str, Any]) -> None:
         """Execute pipeline for the first time and store in database."""
         config = Config(**data)
         if not config.sync_interval_seconds:
             config.sync_interval_seconds = 10_000_000
-            
-        start_pipeline(config)
+        
+        self._check_profile(config.profile)
+        # Profiling only applies to the run it was requested for
+        data.pop("profile", None)
+        backfill = bool(config.destination.backfill)
+        self._check_backfill_target(config, backfill)
+        # Store the entry up front so an interrupted first run can be resumed
         data.update({
-            "status": "completed",
-            "last_run": datetime.now().strftime(self.DATE_FORMAT)
+            "status": "running",
+            "lease_expires_at": self._lease_expiry()
         })
-        self.collection.insert_one(data)
+        if backfill:
+            data["backfill"] = True
+        entry_id = self.collection.insert_one(data).inserted_id
+        try:
+            with self._hold_lease(entry_id):
+                if self.work_queue:
+                    self._enqueue_run(entry_id, config, backfill)
+                    return
+                self._builder().start_pipeline(config, job_id=str(entry_id), backfill=backfill)
+        except Exception:
+            self.collection.delete_one({"_id": entry_id})
+            self._builder().remove_job_work_dir(str(entry_id))
+            raise
+        self._update_entry_status(entry_id, "completed", datetime.now())
+    
+    def _enqueue_run(self, entry_id: Any, config: Config, backfill: bool = False) -> None:
+        """Index the source and queue one task per file for the replicas to process."""
+        if backfill:
+            self._builder().prepare_backfill(config)
+        file_datas = self._builder().index_source(config)
+        # Tasks left over from an interrupted run are superseded by this one
+        self.work_queue.clear(entry_id)
+        if not file_datas:
+            if backfill:
+                self._builder().swap_in_backfill(config)
+            self._update_entry_status(entry_id, "completed", datetime.now())
+            return
+        run_id = uuid.uuid4().hex
+        self.work_queue.enqueue(entry_id, run_id, file_datas)
+        self.collection.update_one(
+            {"_id": entry_id},
+            {"$set": {"status": "queued", "run_id": run_id}, "$unset": {"lease_expires_at": ""}}
+        )
+    
+    def _finalize_queued_runs(self) -> None:
+        """Mark queued runs whose tasks have all finished as completed or failed."""
+        self.work_queue.fail_expired()
+        for entry in self.collection.find({"status": "queued"}):
+            counts = self.work_queue.run_status(entry["_id"], entry["run_id"])
+            if counts.get("pending") or counts.get("claimed"):
+                continue
+            status = "failed" if counts.get("failed") else "completed"
+            backfill = status == "completed" and entry.get("backfill", False)
+            if backfill and not self._swap_in_backfill(entry):
+                continue
+            if status == "completed":
+                self._builder().commit_source_state(Config(**entry))
+            self.collection.update_one(
+                {"_id": entry["_id"], "status": "running" if backfill else "queued", "run_id": entry["run_id"]},
+                {"$set": {"status": status, "last_run": datetime.now().strftime(self.DATE_FORMAT)},
+                 "$unset": {"backfill": "", "lease_expires_at": ""}}
+            )
+            self.work_queue.clear(entry["_id"])
+    
+    def _swap_in_backfill(self, entry: Dict[str, Any]) -> bool:
+        """
+        Swap a queued backfill's shadow collection in once all its tasks are done.
+        Returns False if another replica is swapping it in, or the swap failed.
+        """
+        if not self._claim_entry(entry, backfill=True):
+            return False
+        try:
+            with self._hold_lease(entry["_id"]):
+                self._builder().swap_in_backfill(Config(**entry))
+        except Exception as e:
+            logger.error(f"Failed to swap in the backfill of {entry['_id']}: {e}", exc_info=True)
+            self._update_entry_status(entry["_id"], "failed")
+            self.work_queue.clear(entry["_id"])
+            return False
+        return True
+    
+    def process_tasks(self) -> None:
+        """Claim and run queued per-file tasks until the queue is drained."""
+        while True:
+            tasks = self.work_queue.claim(self.worker_id, self.TASK_BATCH_SIZE)
+            if not tasks:
+                break
+            task_ids = [task["_id"] for task in tasks]
+            entry = self.collection.find_one({"_id": tasks[0]["job_id"]})
+            if not entry:
+                # The source was deleted while its run was queued
+                self.work_queue.clear(tasks[0]["job_id"])
+                continue
+            work_dir = os.path.join(self._builder().WORK_DIR, "tasks", self.worker_id)
+            try:
+                with self.work_queue.hold_lease(task_ids, self.worker_id):
+                    failed = self._builder().start_pipeline_for_files(
+                        Config(**entry), [task["file_data"] for task in tasks], work_dir,
+                        backfill=entry.get("backfill", False))
+            except Exception as e:
+                logger.error(f"Failed to process {len(task_ids)} queued files: {e}", exc_info=True)
+                self.work_queue.release(task_ids, self.worker_id, str(e))
+                continue
+            # A file that failed doesn't count against the others of the batch
+            self.work_queue.complete(
+                [task["_id"] for task in tasks if task["file_data"]["identifier"] not in failed],
+                self.worker_id)
+            for task in tasks:
+                if task["file_data"]["identifier"] in failed:
+                    self.work_queue.release([task["_id"]], self.worker_id, failed[task["file_data"]["identifier"]])
+        self._finalize_queued_runs()
+    
+    def profile_job(self, data: Dict[str, Any]) -> None:
+        """Run a registered job once with profiling enabled."""
+        entry = self.collection.find_one(data)
+        if not entry:
+            raise ValueError("No registered source matches the given filter")
+        self._check_profile(True)
+        if entry["status"] == "running" and not self._lease_expired(entry):
+            raise ValueError("Source is already running")
+        if not self._execute_pipeline(entry, profile=True):
+            raise ValueError("Source was claimed by another run")
+    
+    def rebuild_job(self, data: Dict[str, Any]) -> None:
+        """Rebuild a registered source's whole collection in a shadow collection and swap it in."""
+        entry = self.collection.find_one(data)
+        if not entry:
+            raise ValueError("No registered source matches the given filter")
+        if entry["status"] == "queued" or (entry["status"] == "running" and not self._lease_expired(entry)):
+            raise ValueError("Source is already running")
+        self._check_backfill_target(Config(**entry), True, entry["_id"])
+        if not self._execute_pipeline(entry, backfill=True):
+            raise ValueError("Source was claimed by another run")
     
     def delete_job(self, data) -> None:
         """Delete a scheduled job by ID."""
-        self.collection.delete_one(data)
+        entry = self.collection.find_one_and_delete(data)
+        if not entry:
+            return
+        self._builder().remove_job_work_dir(str(entry["_id"]))
+        self._builder().remove_source_state(Config(**entry))
+        if self.work_queue:
+            self.work_queue.clear(entry["_id"])
 
 
 # For backwards compatibility
@@ -0,0 +1,67 @@
+import asyncio
+import importlib
+import json
+import threading
+from unittest import mock
+
+import pytest
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    # The client only connects on first use
+    monkeypatch.setenv("MONGODB_URI", "mongodb://localhost:27017")
+    monkeypatch.setenv("MONGODB_DATABASE", "app_test")
+    monkeypatch.setenv("MONGODB_COLLECTION", "jobs")
+    monkeypatch.setenv("WORK_QUEUE_ENABLED", "false")
+    return importlib.import_module("app")
+
+
+async def post(app, path: str, payload: dict):
+    """One request straight through the ASGI app, returning its status and JSON body."""
+    messages = [{"type": "http.request", "body": json.dumps(payload).encode(), "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"content-type", b"application/json")], "client": ("test", 1), "server": ("test", 80),
+    }
+    await app(scope, receive, send)
+    status = next(message["status"] for message in sent if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in sent if message["type"] == "http.response.body")
+    return status, json.loads(body)
+
+
+@pytest.mark.parametrize("path, method", [
+    ("/rebuild/source", "rebuild_job"),
+    ("/profile/source", "profile_job"),
+    ("/register/source", "execute_first_time"),
+])
+def test_long_runs_do_not_block_other_requests(app_module, path, method):
+    deleted = threading.Event()
+
+    def long_run(data):
+        # Only returns once the delete request was served while this one was running
+        if not deleted.wait(timeout=5):
+            raise RuntimeError("the event loop was blocked")
+
+    async def requests():
+        return await asyncio.gather(
+            post(app_module.app, path, {"_id": "job"}),
+            post(app_module.app, "/delete/source", {"_id": "other"}),
+        )
+
+    with mock.patch.object(app_module.executor, method, side_effect=long_run), \
+            mock.patch.object(app_module.executor, "delete_job", side_effect=lambda data: deleted.set()):
+        (run_status, run_body), (delete_status, _) = asyncio.run(requests())
+    assert delete_status == 200
+    assert run_status == 200, run_body
@@ -0,0 +1,58 @@
+import json
+
+import numpy as np
+import pytest
+import zstandard
+
+from util.artifacts import load_elements, read_artifact, write_artifact
+
+
+def elements(embeddings) -> list:
+    return [
+        {"element_id": str(i), "text": f"chunk {i}", "metadata": {"page_number": i}, "embeddings": embedding}
+        for i, embedding in enumerate(embeddings)
+    ]
+
+
+def test_float32_embeddings_round_trip(tmp_path):
+    staged = elements(np.random.RandomState(0).rand(3, 4).astype(np.float32).tolist())
+    assert read_artifact(write_artifact(staged, tmp_path / "a.zst")) == staged
+
+
+def test_float64_embeddings_round_trip_losslessly(tmp_path):
+    staged = elements([[0.1, 0.2, 1 / 3], [1e-300, -2.5, 7.0]])
+    assert read_artifact(write_artifact(staged, tmp_path / "a.zst")) == staged
+
+
+def test_elements_without_embeddings_round_trip(tmp_path):
+    staged = elements([[0.5, 0.25], None])
+    del staged[1]["embeddings"]
+    staged.append({"element_id": "title", "text": "Title", "metadata": {}})
+    assert read_artifact(write_artifact(staged, tmp_path / "a.zst")) == staged
+    assert read_artifact(write_artifact(staged[1:], tmp_path / "b.zst")) == staged[1:]
+
+
+def test_load_elements_reads_json_and_artifacts(tmp_path):
+    staged = elements([[0.5, 0.25]])
+    (tmp_path / "a.json").write_text(json.dumps(staged))
+    assert load_elements(tmp_path / "a.json") == staged
+    assert load_elements(write_artifact(staged, tmp_path / "a.zst")) == staged
+
+
+def test_missing_artifact(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_elements(tmp_path / "missing.zst")
+
+
+@pytest.mark.parametrize("corrupt", [
+    lambda data: b"not zstd" + data,
+    lambda data: data[:len(data) // 2],
+    lambda data: zstandard.ZstdCompressor().compress(b"JSON" + bytes(40)),
+    lambda data: zstandard.ZstdCompressor().compress(
+        zstandard.ZstdDecompressor().decompressobj().decompress(data)[:-4]),
+])
+def test_corrupt_artifact(tmp_path, corrupt):
+    path = write_artifact(elements([[0.5, 0.25]]), tmp_path / "a.zst")
+    path.write_bytes(corrupt(path.read_bytes()))
+    with pytest.raises(ValueError):
+        read_artifact(path)
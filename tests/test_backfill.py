@@ -0,0 +1,74 @@
+from unittest import mock
+
+import mongomock
+import pytest
+
+from util.unstructured_mongodb import (
+    MAAPUploader,
+    MongoDBAccessConfig,
+    MongoDBConnectionConfig,
+    MongoDBUploaderConfig,
+)
+
+
+@pytest.fixture
+def client():
+    client = mongomock.MongoClient()
+    db = client["db"]
+    db["chunks"].insert_one({"_id": "live"})
+    db["chunks_files"].insert_one({"_id": "live file"})
+    db["chunks_backfill"].insert_one({"_id": "backfilled"})
+    db["chunks_files_backfill"].insert_one({"_id": "backfilled file"})
+    return client
+
+
+def rename_command(client) -> mock.Mock:
+    """Stands in for the admin command, mongomock has no renameCollection."""
+    def rename(command, source, to, dropTarget):
+        client["db"][source.split(".", 1)[1]].rename(to.split(".", 1)[1], dropTarget=dropTarget)
+    return mock.Mock(side_effect=rename)
+
+
+def swap(client, command: mock.Mock, index_status: dict, timeout: float = 3600.0):
+    uploader = MAAPUploader(
+        upload_config=MongoDBUploaderConfig(search_index_timeout=timeout),
+        connection_config=MongoDBConnectionConfig(
+            access_config=MongoDBAccessConfig(uri="mongodb://localhost"),
+            database="db", collection="chunks", index_name="vector_index",
+            embedding_path="embeddings", embedding_dimensions=3,
+            files_collection="chunks_files",
+            shadow_collection="chunks_backfill", shadow_files_collection="chunks_files_backfill"),
+    )
+
+    with mock.patch.object(MAAPUploader, "create_client", return_value=client), \
+            mock.patch.object(mongomock.collection.Collection, "list_search_indexes", create=True, return_value=[]), \
+            mock.patch.object(mongomock.collection.Collection, "create_search_indexes", create=True), \
+            mock.patch.object(MAAPUploader, "_get_index_config", return_value={"name": "vector_index", **index_status}), \
+            mock.patch("util.unstructured_mongodb.sleep"), \
+            mock.patch.object(mongomock.database.Database, "command", create=True, new=command):
+        uploader.swap_in_shadow()
+
+
+def contents(client):
+    return {name: [doc["_id"] for doc in client["db"][name].find()]
+            for name in sorted(client["db"].list_collection_names())}
+
+
+def test_swap_renames_shadow_collections_over_live_ones(client):
+    command = rename_command(client)
+    swap(client, command, {"status": "READY", "queryable": True})
+    assert command.call_count == 2
+    assert contents(client) == {"chunks": ["backfilled"], "chunks_files": ["backfilled file"]}
+
+
+@pytest.mark.parametrize("index_status, timeout, error", [
+    ({"status": "FAILED", "queryable": False}, 3600.0, RuntimeError),
+    ({"status": "BUILDING", "queryable": False}, 0.0, TimeoutError),
+])
+def test_failed_index_build_keeps_the_live_collection(client, index_status, timeout, error):
+    before = contents(client)
+    command = rename_command(client)
+    with pytest.raises(error):
+        swap(client, command, index_status, timeout)
+    command.assert_not_called()
+    assert contents(client) == before
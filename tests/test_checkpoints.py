@@ -0,0 +1,89 @@
+import shutil
+from dataclasses import dataclass
+from unittest import mock
+
+import pytest
+from unstructured_ingest.v2.interfaces import DownloadResponse, FileData, ProcessorConfig
+from unstructured_ingest.v2.pipeline.pipeline import Pipeline, PipelineError
+from unstructured_ingest.v2.processes.connectors.local import (
+    LocalDownloader,
+    LocalDownloaderConfig,
+    LocalIndexer,
+    LocalIndexerConfig,
+    LocalUploader,
+    LocalUploaderConfig,
+)
+from unstructured_ingest.v2.processes.partitioner import Partitioner, PartitionerConfig
+
+from util.checkpoints import CheckpointedDownloadStep
+
+
+@dataclass
+class CopyingDownloader(LocalDownloader):
+    """Copies files into the download dir, as remote sources do, so downloads get a fresh mtime."""
+
+    def get_download_path(self, file_data: FileData):
+        return self.download_dir / file_data.source_identifiers.relative_path
+
+    def run(self, file_data: FileData, **kwargs) -> DownloadResponse:
+        download_path = self.get_download_path(file_data)
+        download_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy(file_data.source_identifiers.fullpath, download_path)
+        return DownloadResponse(file_data=file_data, path=download_path)
+
+
+@dataclass
+class TextPartitioner(Partitioner):
+    """One element per file, without unstructured's partitioning."""
+
+    def run(self, filename, metadata=None, **kwargs):
+        return [{"type": "NarrativeText", "element_id": filename.name, "text": filename.read_text(),
+                 "metadata": metadata or {}}]
+
+
+def build_pipeline(tmp_path, resume: bool) -> Pipeline:
+    pipeline = Pipeline(
+        context=ProcessorConfig(
+            reprocess=not resume,
+            re_download=not resume,
+            work_dir=str(tmp_path / "work"),
+            disable_parallelism=True,
+        ),
+        indexer=LocalIndexer(index_config=LocalIndexerConfig(input_path=str(tmp_path / "source"))),
+        downloader=CopyingDownloader(download_config=LocalDownloaderConfig(download_dir=tmp_path / "download")),
+        partitioner=TextPartitioner(config=PartitionerConfig()),
+        uploader=LocalUploader(upload_config=LocalUploaderConfig(output_dir=str(tmp_path / "output"))),
+    )
+    pipeline.downloader_step = CheckpointedDownloadStep(
+        process=pipeline.downloader_step.process, context=pipeline.context)
+    return pipeline
+
+
+def test_resume_skips_finished_steps(tmp_path):
+    (tmp_path / "source").mkdir()
+    for name in ("a", "b"):
+        (tmp_path / "source" / f"{name}.txt").write_text(f"Contents of {name}, a sentence or two.")
+    # The first run is interrupted after downloading and partitioning every file
+    with mock.patch.object(LocalUploader, "run", side_effect=RuntimeError("interrupted")), \
+            pytest.raises(PipelineError):
+        build_pipeline(tmp_path, resume=False).run()
+
+    with mock.patch.object(CopyingDownloader, "run", autospec=True) as download, \
+            mock.patch.object(TextPartitioner, "run", autospec=True) as partition:
+        build_pipeline(tmp_path, resume=True).run()
+    download.assert_not_called()
+    partition.assert_not_called()
+    assert sorted(path.name for path in (tmp_path / "output").iterdir()) == ["a.txt.json", "b.txt.json"]
+
+
+def test_resume_downloads_changed_files_again(tmp_path):
+    (tmp_path / "source").mkdir()
+    source = tmp_path / "source" / "a.txt"
+    source.write_text("First version of the file.")
+    build_pipeline(tmp_path, resume=False).run()
+
+    source.write_text("Second version of the file.")
+    with mock.patch.object(TextPartitioner, "run", autospec=True, side_effect=TextPartitioner.run) as partition:
+        build_pipeline(tmp_path, resume=True).run()
+    partition.assert_called_once()
+    assert (tmp_path / "download" / "a.txt").read_text() == "Second version of the file."
@@ -0,0 +1,143 @@
+from unittest import mock
+
+import mongomock
+import pytest
+from pydantic import ValidationError
+
+from util.base_configs import DestinationConfig
+from util.dedup import ChunkDedupConfig, DedupChunkStep, MinHashLSH, MongoDedupIndex, relist_sources
+
+TEXT = ("The quarterly report shows that revenue grew by twelve percent while operating costs "
+        "stayed flat, driven mostly by the new subscription plans launched in the spring.")
+NEAR_DUPLICATE = TEXT.replace("spring", "summer")
+UNRELATED = ("Pour the batter into a greased tin and bake it for forty minutes, "
+             "until a skewer pushed into the middle comes out clean.")
+
+
+def dedup_step(tmp_path, source: str, **kwargs) -> DedupChunkStep:
+    # Skips ChunkStep's setup, deduplicate only needs the dedup config
+    step = object.__new__(DedupChunkStep)
+    step.dedup_config = ChunkDedupConfig(
+        index="local", local_path=str(tmp_path / "dedup.sqlite"), source=source, **kwargs)
+    step._lsh = MinHashLSH(num_perm=step.dedup_config.num_perm, bands=step.dedup_config.bands)
+    step._index = None
+    step._index_pid = None
+    return step
+
+
+def chunk(text: str, element_id: str) -> dict:
+    return {"element_id": element_id, "text": text, "metadata": {}}
+
+
+@pytest.fixture
+def relisted():
+    with mock.patch("util.dedup.relist_sources") as relist:
+        yield relist
+
+
+def test_similar_texts_share_band_keys():
+    lsh = MinHashLSH()
+    text, near, unrelated = (lsh.signature(t) for t in (TEXT, NEAR_DUPLICATE, UNRELATED))
+    assert lsh.similarity(text, text) == 1.0
+    assert lsh.similarity(text, near) > 0.5
+    assert lsh.similarity(text, unrelated) < 0.1
+    assert set(lsh.band_keys(text)) & set(lsh.band_keys(near))
+    assert not set(lsh.band_keys(text)) & set(lsh.band_keys(unrelated))
+
+
+def test_signatures_are_stable_across_instances():
+    assert (MinHashLSH().signature(TEXT) == MinHashLSH().signature(TEXT)).all()
+
+
+def test_near_duplicates_of_other_sources_are_dropped(tmp_path, relisted):
+    dedup_step(tmp_path, "source-a").deduplicate([chunk(TEXT, "a1")], file="a.txt")
+    kept = dedup_step(tmp_path, "source-b").deduplicate(
+        [chunk(NEAR_DUPLICATE, "b1"), chunk(UNRELATED, "b2")], file="b.txt")
+    assert [c["element_id"] for c in kept] == ["b2"]
+
+
+def test_near_duplicates_are_marked_with_their_canonical_chunk(tmp_path, relisted):
+    dedup_step(tmp_path, "source-a").deduplicate([chunk(TEXT, "a1")], file="a.txt")
+    kept = dedup_step(tmp_path, "source-b", mode="mark").deduplicate(
+        [chunk(NEAR_DUPLICATE, "b1"), chunk(UNRELATED, "b2")], file="b.txt")
+    assert [c["metadata"].get("duplicate_of") for c in kept] == ["a1", None]
+
+
+def test_chunks_below_the_threshold_are_kept(tmp_path, relisted):
+    lsh = MinHashLSH()
+    similarity = lsh.similarity(lsh.signature(TEXT), lsh.signature(NEAR_DUPLICATE))
+    dedup_step(tmp_path, "source-a").deduplicate([chunk(TEXT, "a1")], file="a.txt")
+    kept = dedup_step(tmp_path, "source-b", threshold=min(1.0, similarity + 0.01)).deduplicate(
+        [chunk(NEAR_DUPLICATE, "b1")], file="b.txt")
+    assert [c["element_id"] for c in kept] == ["b1"]
+
+
+def test_chunks_of_the_same_source_are_not_compared(tmp_path, relisted):
+    step = dedup_step(tmp_path, "source-a")
+    step.deduplicate([chunk(TEXT, "a1")], file="a.txt")
+    kept = step.deduplicate([chunk(TEXT, "a2")], file="other.txt")
+    assert [c["element_id"] for c in kept] == ["a2"]
+
+
+def test_removed_canonical_chunks_relist_the_dropping_sources(tmp_path, relisted):
+    dedup_step(tmp_path, "source-a").deduplicate([chunk(TEXT, "a1")], file="a.txt")
+    dedup_step(tmp_path, "source-b").deduplicate([chunk(NEAR_DUPLICATE, "b1")], file="b.txt")
+    relisted.reset_mock()
+    # The file no longer has the canonical chunk
+    dedup_step(tmp_path, "source-a").deduplicate([chunk(UNRELATED, "a2")], file="a.txt")
+    relisted.assert_called_once_with(["source-b"])
+
+
+def test_mongodb_index_only_returns_other_sources_candidates():
+    client = mongomock.MongoClient()
+    config = ChunkDedupConfig(mongodb_uri="mongodb://localhost", database="db", collection="chunks_minhash")
+    with mock.patch("util.dedup.MongoClient", return_value=client):
+        index = MongoDedupIndex(config)
+    index.add([
+        {"_id": "a", "element_id": "a1", "source": "source-a", "file": "a.txt", "signature": b"", "bands": ["0:x"]},
+        {"_id": "b", "element_id": "b1", "source": "source-b", "file": "b.txt", "signature": b"", "bands": ["0:x"]},
+    ])
+    assert [entry[0] for entry in index.candidates(["0:x"], "source-a")] == ["b"]
+    index.link([("b", "a2", "source-a")])
+    assert index.remove("source-b") == ["source-a"]
+    assert client["db"]["chunks_minhash"].count_documents({}) == 1
+
+
+def test_relist_sources_resets_their_change_tokens():
+    collection = mongomock.MongoClient()["db"]["jobs_state"]
+    collection.insert_many([
+        {"_id": "source-a", "page_token": "1", "pending_page_token": "2"},
+        {"_id": "source-b", "page_token": "3"},
+    ])
+    with mock.patch("util.unstructured_google_drive.ChangeTokenStore.get_collection", return_value=collection):
+        relist_sources(["source-a"])
+    assert list(collection.find()) == [{"_id": "source-a"}, {"_id": "source-b", "page_token": "3"}]
+
+
+@pytest.mark.parametrize("settings", [
+    {"index": "mongo"},
+    {"mode": "remove"},
+    {"threshold": 0},
+    {"threshold": 85},
+    {"num_perm": 100},
+    {"database": "db.name"},
+    {"collection": "chunks$minhash"},
+    {"collection": "system.minhash"},
+    {"mongodb_uri": None},
+    {"index": "local", "local_path": None},
+])
+def test_invalid_dedup_settings_are_rejected(settings):
+    config = {"mongodb_uri": "mongodb://localhost", "database": "db", "collection": "chunks_minhash",
+              "source": "source-a", **settings}
+    with pytest.raises(ValidationError):
+        ChunkDedupConfig(**config)
+
+
+@pytest.mark.parametrize("settings", [
+    {"dedup": "remove"},
+    {"dedup_index": "mongo"},
+    {"dedup_threshold": 1.5},
+])
+def test_invalid_destination_dedup_settings_are_rejected(settings):
+    with pytest.raises(ValidationError):
+        DestinationConfig(mongodb_uri="mongodb://localhost", database="db", collection="chunks", **settings)
@@ -0,0 +1,95 @@
+import mongomock
+import pytest
+from unstructured_ingest.v2.interfaces import FileData, FileDataSourceMetadata, SourceIdentifiers
+
+from util.unstructured_mongodb import (
+    MAAPUploader,
+    MongoDBAccessConfig,
+    MongoDBConnectionConfig,
+    MongoDBUploaderConfig,
+)
+
+
+def uploader(**kwargs) -> MAAPUploader:
+    return MAAPUploader(
+        upload_config=MongoDBUploaderConfig(),
+        connection_config=MongoDBConnectionConfig(
+            access_config=MongoDBAccessConfig(uri="mongodb://localhost"),
+            database="db", collection="chunks", index_name="vector_index",
+            embedding_path="embeddings", diff_writes=True, source_key="source-a", **kwargs),
+    )
+
+
+def file_data(path: str) -> FileData:
+    return FileData(
+        identifier=path,
+        connector_type="local",
+        source_identifiers=SourceIdentifiers(filename=path.rsplit("/", 1)[-1], fullpath=path),
+        metadata=FileDataSourceMetadata(record_locator={"path": path}),
+    )
+
+
+def chunk(text: str, path: str = "/data/a.txt", run: int = 1) -> dict:
+    return {
+        "element_id": f"{text}-{run}",
+        "text": text,
+        "type": "NarrativeText",
+        "doc_id": text,
+        "embeddings": [0.1, 0.2],
+        "metadata": {
+            "page_number": 1,
+            "orig_elements": f"processed in run {run}",
+            "data_source": {"record_locator": {"path": path}},
+        },
+    }
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient()["db"]["chunks"]
+
+
+def texts(collection, query=None):
+    return sorted(doc["text"] for doc in collection.find(query or {}))
+
+
+def test_unchanged_chunks_are_kept_across_runs(collection):
+    writer = uploader()
+    writer._write_diff(collection, [chunk("one"), chunk("two")], file_data("/data/a.txt"))
+    ids = {doc["_id"] for doc in collection.find()}
+    # New element ids and orig_elements don't make a chunk new
+    writer._write_diff(collection, [chunk("one", run=2), chunk("three", run=2)], file_data("/data/a.txt"))
+    assert texts(collection) == ["one", "three"]
+    assert ids & {doc["_id"] for doc in collection.find()} == {
+        doc["_id"] for doc in collection.find({"text": "one"})}
+
+
+@pytest.mark.parametrize("changed", [
+    {"embedder_identity": '{"provider": "onnx"}'},
+    {"chunk_fields": ["text"]},
+])
+def test_new_embedder_or_projection_rewrites_every_chunk(collection, changed):
+    uploader()._write_diff(collection, [chunk("one"), chunk("two")], file_data("/data/a.txt"))
+    before = {doc["_id"] for doc in collection.find()}
+    uploader(**changed)._write_diff(collection, [chunk("one"), chunk("two")], file_data("/data/a.txt"))
+    assert texts(collection) == ["one", "two"]
+    assert not before & {doc["_id"] for doc in collection.find()}
+
+
+def test_legacy_chunks_are_replaced_by_record_locator(collection):
+    collection.insert_many([
+        chunk("stale"),
+        # Same file name elsewhere, and the same file loaded by another source
+        chunk("other file", path="/other/a.txt"),
+        {**chunk("other source"), "source_key": "source-b"},
+    ])
+    uploader()._write_diff(collection, [chunk("fresh")], file_data("/data/a.txt"))
+    assert texts(collection) == ["fresh", "other file", "other source"]
+
+
+def test_files_without_record_locator_skip_legacy_cleanup(collection):
+    collection.insert_one(chunk("stale"))
+    data = file_data("/data/a.txt")
+    data.metadata.record_locator = None
+    uploader()._write_diff(collection, [chunk("fresh")], data)
+    assert texts(collection) == ["fresh", "stale"]
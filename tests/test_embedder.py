@@ -0,0 +1,74 @@
+import json
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import pytest
+
+from util.builder import PipelineBuilder
+from util.unstructured_embedder import OnnxEmbedderConfig, OnnxEmbeddingEncoder, model_normalizes
+
+SENTENCE_TRANSFORMER_MODULES = [
+    {"idx": 0, "name": "0", "path": "", "type": "sentence_transformers.models.Transformer"},
+    {"idx": 1, "name": "1", "path": "1_Pooling", "type": "sentence_transformers.models.Pooling"},
+]
+
+
+def model_dir(tmp_path, modules=None):
+    if modules is not None:
+        (tmp_path / "modules.json").write_text(json.dumps(modules))
+    return str(tmp_path)
+
+
+class Tokenizer:
+    def encode_batch(self, texts):
+        return [SimpleNamespace(ids=[1, 2], attention_mask=[1, 1], type_ids=[0, 0]) for _ in texts]
+
+
+class Session:
+    """Embeds every token as [3, 4], whose length is 5."""
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="input_ids"), SimpleNamespace(name="attention_mask")]
+
+    def run(self, outputs, feeds):
+        return [np.full((*feeds["input_ids"].shape, 2), [3.0, 4.0], dtype=np.float32)]
+
+
+def embed(config: OnnxEmbedderConfig) -> list:
+    encoder = config.get_embedder()
+    with mock.patch.object(OnnxEmbeddingEncoder, "_session", return_value=Session()), \
+            mock.patch.object(OnnxEmbeddingEncoder, "_tokenizer", return_value=Tokenizer()):
+        return encoder.embed_query("text")
+
+
+@pytest.mark.parametrize("modules, expected", [
+    (None, True),
+    (SENTENCE_TRANSFORMER_MODULES, False),
+    (SENTENCE_TRANSFORMER_MODULES + [
+        {"idx": 2, "name": "2", "path": "2_Normalize", "type": "sentence_transformers.models.Normalize"}], True),
+])
+def test_normalization_follows_the_model(tmp_path, modules, expected):
+    directory = model_dir(tmp_path, modules)
+    assert model_normalizes(directory) is expected
+    config = OnnxEmbedderConfig(embedding_provider="onnx", embedding_model_dir=directory)
+    assert embed(config) == pytest.approx([0.6, 0.8] if expected else [3.0, 4.0])
+
+
+@pytest.mark.parametrize("setting, expected", [("false", [3.0, 4.0]), ("true", [0.6, 0.8])])
+def test_normalize_setting_overrides_the_model(tmp_path, monkeypatch, setting, expected):
+    monkeypatch.setenv("EMBEDDING_BACKEND", "onnx")
+    monkeypatch.setenv("EMBEDDING_MODEL_DIR", model_dir(tmp_path, SENTENCE_TRANSFORMER_MODULES))
+    monkeypatch.setenv("EMBEDDING_NORMALIZE", setting)
+    config = PipelineBuilder().configure_embedder_config().embedder_config
+    assert embed(config) == pytest.approx(expected)
+
+
+def test_normalization_is_part_of_the_embedder_identity(tmp_path):
+    directory = model_dir(tmp_path)
+    identities = {
+        OnnxEmbedderConfig(embedding_provider="onnx", embedding_model_dir=directory, embedding_normalize=normalize)
+        .identity() for normalize in (None, True, False)
+    }
+    # Unset resolves to the model's own behavior
+    assert len(identities) == 2
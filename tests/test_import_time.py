@@ -0,0 +1,66 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from util.connectors import SOURCE_CONNECTORS, load
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules that made importing the app slow, loaded only once a pipeline is built
+HEAVY_MODULES = [
+    "unstructured_ingest.v2.processes",
+    "unstructured_ingest.v2.pipeline",
+    "unstructured",
+    "util.builder",
+    "util.unstructured_mongodb",
+    "onnxruntime",
+    "tokenizers",
+    "torch",
+    "transformers",
+    "sentence_transformers",
+    "googleapiclient",
+    "boto3",
+    "fsspec",
+]
+
+IMPORT_SCRIPT = """
+import json, sys
+import {module}
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def cold_import(module: str) -> list:
+    """Names of the modules loaded by importing a module in a fresh interpreter."""
+    env = {
+        **os.environ,
+        # Clients are created on import but only connect on first use
+        "MONGODB_URI": "mongodb://localhost:27017",
+        "MONGODB_DATABASE": "import_time",
+        "MONGODB_COLLECTION": "jobs",
+        "WORK_QUEUE_ENABLED": "false",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module", ["app", "pipeline_executor"])
+def test_import_loads_no_heavy_modules(module):
+    loaded = [
+        name for name in cold_import(module)
+        if any(name == heavy or name.startswith(f"{heavy}.") for heavy in HEAVY_MODULES)
+    ]
+    assert loaded == []
+
+
+@pytest.mark.parametrize("source_type", sorted(SOURCE_CONNECTORS))
+def test_connector_registry_resolves(source_type):
+    for path in SOURCE_CONNECTORS[source_type].values():
+        assert isinstance(load(path), type), path
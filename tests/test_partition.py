@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import pytest
+
+from util.unstructured_partition import (
+    AdaptiveConcurrencyLimiter,
+    PooledPartitioner,
+    PooledPartitionerConfig,
+    partition_url,
+)
+
+ELEMENTS = [{"type": "NarrativeText", "element_id": "1", "text": "Hello", "metadata": {}}]
+
+
+class PartitionAPI(BaseHTTPRequestHandler):
+    """Answers with the queued (status, headers) replies, then with elements."""
+    replies = []
+    paths = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        type(self).paths.append(self.path)
+        if self.path != "/general/v0/general":
+            status, headers = 404, {}
+        elif type(self).replies:
+            status, headers = type(self).replies.pop(0)
+        else:
+            status, headers = 200, {}
+        body = json.dumps(ELEMENTS if status == 200 else {"detail": "error"}).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api():
+    PartitionAPI.replies, PartitionAPI.paths = [], []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PartitionAPI)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def partitioner(endpoint: str, **kwargs) -> PooledPartitioner:
+    return PooledPartitioner(config=PooledPartitionerConfig(
+        partition_by_api=True, partition_endpoint=endpoint, api_key="key", **kwargs))
+
+
+@pytest.mark.parametrize("endpoint, url", [
+    ("https://api.unstructuredapp.io", "https://api.unstructuredapp.io/general/v0/general"),
+    ("https://api.unstructuredapp.io/general/v0/general", "https://api.unstructuredapp.io/general/v0/general"),
+    ("http://localhost:8000/", "http://localhost:8000/general/v0/general"),
+    ("localhost:8000", "http://localhost:8000/general/v0/general"),
+    ("api.example.com", "https://api.example.com/general/v0/general"),
+])
+def test_partition_url(endpoint, url):
+    assert partition_url(endpoint) == url
+
+
+@pytest.mark.parametrize("path", ["", "/", "/general/v0/general"])
+def test_post_accepts_base_and_endpoint_urls(api, path):
+    assert partitioner(api + path)._post("a.txt", b"Hello") == ELEMENTS
+    assert PartitionAPI.paths == ["/general/v0/general"]
+
+
+def test_post_retries_throttled_requests_and_backs_off(api):
+    PartitionAPI.replies = [(429, {"Retry-After": "3"}), (503, {})]
+    pooled = partitioner(api, initial_concurrency=8)
+    with mock.patch("util.unstructured_partition.time.sleep") as sleep:
+        assert pooled._post("a.txt", b"Hello") == ELEMENTS
+    assert len(PartitionAPI.paths) == 3
+    # Retry-After is honored, then exponential backoff, both with up to a second of jitter
+    assert 3 <= sleep.call_args_list[0].args[0] < 4
+    assert 2 <= sleep.call_args_list[1].args[0] < 3
+    # Halved by the first failure, and by the second, which started after that decrease
+    assert int(pooled._limiter.limit) == 2
+
+
+def test_post_gives_up_after_max_retries(api):
+    PartitionAPI.replies = [(500, {})] * 3
+    pooled = partitioner(api, max_retries=2)
+    with mock.patch("util.unstructured_partition.time.sleep"), pytest.raises(Exception, match="500"):
+        pooled._post("a.txt", b"Hello")
+    assert len(PartitionAPI.paths) == 3
+
+
+def test_post_does_not_retry_client_errors(api):
+    PartitionAPI.replies = [(422, {})]
+    with pytest.raises(Exception, match="422"):
+        partitioner(api)._post("a.txt", b"Hello")
+    assert len(PartitionAPI.paths) == 1
+
+
+def test_limiter_grows_under_target_latency_and_halves_once_per_burst():
+    limiter = AdaptiveConcurrencyLimiter(initial=4, minimum=1, maximum=8, target_latency=10)
+    # Each success under the target adds 1/limit, about one per window of limit requests
+    for _ in range(5):
+        with limiter.slot() as started:
+            pass
+        limiter.record(started, ok=True)
+    assert int(limiter.limit) == 5
+
+    burst = []
+    for _ in range(3):
+        with limiter.slot() as started:
+            burst.append(started)
+    for started in burst:
+        limiter.record(started, ok=False)
+    assert int(limiter.limit) == 2
+
+    limiter.record(time.monotonic(), ok=False)
+    limiter.record(time.monotonic(), ok=False)
+    assert limiter.limit == 1
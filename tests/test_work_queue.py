@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import mongomock
+import pytest
+
+import pipeline_executor
+from pipeline_executor import PipelineExecutor
+from util.work_queue import WorkQueue
+
+ENTRY = {
+    "sync_interval_seconds": 3600,
+    "source": {"source_type": "local", "params": {"input_path": "/data"}},
+    "destination": {"mongodb_uri": "mongodb://localhost", "database": "db", "collection": "chunks"},
+}
+
+
+def file_datas(*identifiers):
+    return [{"identifier": identifier} for identifier in identifiers]
+
+
+@pytest.fixture
+def queue():
+    queue = WorkQueue(mongomock.MongoClient()["db"]["tasks"])
+    queue.create_indexes()
+    return queue
+
+
+def expire_leases(queue):
+    queue.collection.update_many(
+        {"status": "claimed"}, {"$set": {"lease_expires_at": datetime.now() - timedelta(seconds=1)}})
+
+
+def statuses(queue):
+    return {task["file_data"]["identifier"]: task["status"] for task in queue.collection.find()}
+
+
+def test_claim_batches_tasks_of_one_run(queue):
+    queue.enqueue("job1", "run1", file_datas("a", "b", "c"))
+    queue.enqueue("job2", "run2", file_datas("d"))
+    first = queue.claim("w1", batch_size=10)
+    assert {task["job_id"] for task in first} == {first[0]["job_id"]}
+    second = queue.claim("w2", batch_size=10)
+    assert {task["job_id"] for task in first + second} == {"job1", "job2"}
+    assert queue.claim("w3", batch_size=10) == []
+    assert all(task["attempts"] == 1 for task in first + second)
+
+
+def test_claim_respects_batch_size(queue):
+    queue.enqueue("job1", "run1", file_datas("a", "b", "c"))
+    assert len(queue.claim("w1", batch_size=2)) == 2
+    assert len(queue.claim("w2", batch_size=2)) == 1
+
+
+def test_expired_lease_is_claimed_again(queue):
+    queue.enqueue("job1", "run1", file_datas("a"))
+    [task] = queue.claim("w1", batch_size=1)
+    assert queue.claim("w2", batch_size=1) == []
+
+    expire_leases(queue)
+    [reclaimed] = queue.claim("w2", batch_size=1)
+    assert reclaimed["_id"] == task["_id"]
+    assert reclaimed["worker_id"] == "w2"
+    assert reclaimed["attempts"] == 2
+
+
+def test_worker_that_lost_its_lease_cannot_complete(queue):
+    queue.enqueue("job1", "run1", file_datas("a"))
+    [task] = queue.claim("w1", batch_size=1)
+    expire_leases(queue)
+    queue.claim("w2", batch_size=1)
+
+    queue.complete([task["_id"]], "w1")
+    queue.release([task["_id"]], "w1", "late failure")
+    assert statuses(queue) == {"a": "claimed"}
+    queue.complete([task["_id"]], "w2")
+    assert statuses(queue) == {"a": "done"}
+
+
+def test_renew_extends_only_own_leases(queue):
+    queue.enqueue("job1", "run1", file_datas("a"))
+    [task] = queue.claim("w1", batch_size=1)
+    expire_leases(queue)
+    queue.renew([task["_id"]], "w2")
+    assert queue.collection.find_one()["lease_expires_at"] < datetime.now()
+    queue.renew([task["_id"]], "w1")
+    assert queue.collection.find_one()["lease_expires_at"] > datetime.now()
+
+
+def test_release_retries_until_max_attempts(queue):
+    queue.enqueue("job1", "run1", file_datas("a"))
+    for attempt in range(1, WorkQueue.MAX_ATTEMPTS + 1):
+        [task] = queue.claim("w1", batch_size=1)
+        assert task["attempts"] == attempt
+        queue.release([task["_id"]], "w1", "boom")
+    assert statuses(queue) == {"a": "failed"}
+    assert queue.claim("w1", batch_size=1) == []
+
+
+def test_crashing_task_fails_after_max_attempts(queue):
+    queue.enqueue("job1", "run1", file_datas("a"))
+    for _ in range(WorkQueue.MAX_ATTEMPTS):
+        assert queue.claim("w1", batch_size=1)
+        # The worker dies without completing or releasing the task
+        expire_leases(queue)
+    assert queue.claim("w1", batch_size=1) == []
+    queue.fail_expired()
+    assert statuses(queue) == {"a": "failed"}
+    assert queue.run_status("job1", "run1") == {"failed": 1}
+
+
+@pytest.fixture
+def executor(queue, monkeypatch):
+    monkeypatch.setenv("WORK_QUEUE_ENABLED", "true")
+    jobs = queue.collection.database["jobs"]
+    with mock.patch.object(pipeline_executor.MongoDBConnection, "get_collection", return_value=jobs), \
+            mock.patch.object(pipeline_executor.MongoDBConnection, "get_task_collection",
+                              return_value=queue.collection), \
+            mock.patch.object(PipelineExecutor, "_builder") as builder:
+        executor = PipelineExecutor()
+        executor.builder = builder.return_value
+        yield executor
+
+
+def queued_entry(executor, identifiers):
+    entry_id = executor.collection.insert_one({**ENTRY, "status": "queued", "run_id": "run1"}).inserted_id
+    executor.work_queue.enqueue(entry_id, "run1", file_datas(*identifiers))
+    return entry_id
+
+
+def test_finalize_waits_for_unfinished_tasks(executor):
+    entry_id = queued_entry(executor, ["a", "b"])
+    [task, _] = executor.work_queue.claim("w1", batch_size=2)
+    executor.work_queue.complete([task["_id"]], "w1")
+    executor._finalize_queued_runs()
+    assert executor.collection.find_one({"_id": entry_id})["status"] == "queued"
+    executor.builder.commit_source_state.assert_not_called()
+
+
+def test_finalize_completes_run_and_commits_source_state(executor):
+    entry_id = queued_entry(executor, ["a", "b"])
+    tasks = executor.work_queue.claim("w1", batch_size=2)
+    executor.work_queue.complete([task["_id"] for task in tasks], "w1")
+    executor._finalize_queued_runs()
+    entry = executor.collection.find_one({"_id": entry_id})
+    assert entry["status"] == "completed"
+    assert "last_run" in entry
+    executor.builder.commit_source_state.assert_called_once()
+    assert executor.work_queue.collection.count_documents({"job_id": entry_id}) == 0
+
+
+def test_finalize_fails_run_whose_task_lost_its_last_lease(executor):
+    entry_id = queued_entry(executor, ["a", "b"])
+    done, crashed = executor.work_queue.claim("w1", batch_size=2)
+    executor.work_queue.complete([done["_id"]], "w1")
+    executor.work_queue.collection.update_one(
+        {"_id": crashed["_id"]},
+        {"$set": {"attempts": WorkQueue.MAX_ATTEMPTS, "lease_expires_at": datetime.now() - timedelta(seconds=1)}})
+    executor._finalize_queued_runs()
+    assert executor.collection.find_one({"_id": entry_id})["status"] == "failed"
+    executor.builder.commit_source_state.assert_not_called()
+
+
+def test_process_tasks_fails_files_one_by_one(executor):
+    entry_id = queued_entry(executor, ["a", "b"])
+    executor.builder.WORK_DIR = "/tmp/work"
+    executor.builder.start_pipeline_for_files.return_value = {"b": "cannot partition"}
+    # Keep the finished run's tasks to look at them
+    with mock.patch.object(executor.work_queue, "clear"):
+        executor.process_tasks()
+    assert statuses(executor.work_queue) == {"a": "done", "b": "failed"}
+    assert executor.builder.start_pipeline_for_files.call_count == WorkQueue.MAX_ATTEMPTS
+    assert executor.collection.find_one({"_id": entry_id})["status"] == "failed"
+
+
+def test_profiling_is_refused_in_queue_mode(executor):
+    executor.collection.insert_one({**ENTRY, "status": "completed", "last_run": "2024-01-01 00:00:00"})
+    with pytest.raises(ValueError, match="work queue"):
+        executor.profile_job({"source.source_type": "local"})
+    with pytest.raises(ValueError, match="work queue"):
+        executor.execute_first_time({**ENTRY, "profile": True})
+    executor.builder.start_pipeline.assert_not_called()
+    executor.builder.index_source.assert_not_called()
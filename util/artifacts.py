@@ -0,0 +1,74 @@
+import json
+import struct
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+from unstructured_ingest.utils.dep_check import requires_dependencies
+
+EMBEDDINGS_KEY = "embeddings"
+ARTIFACT_SUFFIX = ".zst"
+ARTIFACT_MAGIC = b"EDL1"
+# Magic, size of the JSON part, rows and columns of the embedding matrix and its dtype
+ARTIFACT_HEADER = struct.Struct("<4sQII3s")
+
+
+@requires_dependencies(["zstandard"])
+def write_artifact(elements: List[Dict[str, Any]], path: Path, level: int = 3) -> Path:
+    """
+    Write elements as a zstd-compressed artifact: the header, the elements
+    without their embeddings as compact JSON, then the embeddings as one
+    little-endian matrix. The matrix is float32 when that holds every value
+    exactly, as it does for float32 model outputs, and float64 otherwise.
+    """
+    import zstandard
+
+    embedded = [i for i, element in enumerate(elements) if element.get(EMBEDDINGS_KEY) is not None]
+    matrix = np.asarray([elements[i][EMBEDDINGS_KEY] for i in embedded], dtype="<f8")
+    if np.array_equal(matrix.astype("<f4"), matrix):
+        matrix = matrix.astype("<f4")
+    if not embedded:
+        matrix = matrix.reshape(0, 0)
+    body = json.dumps({
+        "elements": [{k: v for k, v in element.items() if k != EMBEDDINGS_KEY} for element in elements],
+        "embedded": embedded,
+    }, separators=(",", ":")).encode()
+    with open(path, "wb") as f, zstandard.ZstdCompressor(level=level).stream_writer(f) as writer:
+        writer.write(ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, len(body), *matrix.shape, matrix.dtype.str.encode()))
+        writer.write(body)
+        writer.write(matrix.tobytes())
+    return path
+
+
+@requires_dependencies(["zstandard"])
+def read_artifact(path: Path) -> List[Dict[str, Any]]:
+    import zstandard
+
+    with open(path, "rb") as f:
+        try:
+            data = zstandard.ZstdDecompressor().stream_reader(f).readall()
+        except zstandard.ZstdError as e:
+            raise ValueError(f"{path} is not a valid zstd artifact: {e}") from e
+    if len(data) < ARTIFACT_HEADER.size or data[:len(ARTIFACT_MAGIC)] != ARTIFACT_MAGIC:
+        raise ValueError(f"{path} is not an element artifact")
+    magic, body_size, rows, columns, dtype = ARTIFACT_HEADER.unpack_from(data)
+    dtype = dtype.decode()
+    if len(data) != ARTIFACT_HEADER.size + body_size + rows * columns * np.dtype(dtype).itemsize:
+        raise ValueError(f"{path} is truncated or corrupt")
+    body = json.loads(data[ARTIFACT_HEADER.size:ARTIFACT_HEADER.size + body_size])
+    matrix = np.frombuffer(
+        data, dtype=dtype, count=rows * columns, offset=ARTIFACT_HEADER.size + body_size,
+    ).reshape(rows, columns)
+    elements = body["elements"]
+    for i, embedding in zip(body["embedded"], matrix.tolist()):
+        elements[i][EMBEDDINGS_KEY] = embedding
+    return elements
+
+
+def load_elements(path: Path) -> List[Dict[str, Any]]:
+    """Staged elements, from either a JSON file or a compressed artifact."""
+    if Path(path).suffix == ARTIFACT_SUFFIX:
+        return read_artifact(path)
+    with open(path) as f:
+        return json.load(f)
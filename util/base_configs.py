@@ -1,5 +1,5 @@
 from contextlib import asynccontextmanager
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
@@ -19,6 +19,13 @@ class DestinationConfig(BaseModel):
     id_fields: Optional[List[str]] = Field(default=["text"], description="Fields to be used to create the document ID")
     create_md5: Optional[bool] = Field(default=False, description="Whether to create an MD5 hash of the document")
     batch_size: Optional[int] = Field(default=100, description="Number of documents to upload in each batch")
+    chunk_fields: Optional[List[str]] = Field(default=None, description="Dotted paths of the fields kept on chunk documents, all fields if unset")
+    normalize_metadata: Optional[bool] = Field(default=False, description="Whether to move per-file metadata into a <collection>_files document referenced by file_id")
+    dedup: Optional[Literal["drop", "mark"]] = Field(default=None, description="Near-duplicate chunks across sources: drop or mark them, unset to keep them all")
+    dedup_threshold: float = Field(default=0.85, gt=0, le=1, description="Similarity above which chunks are near-duplicates")
+    dedup_index: Literal["mongodb", "local"] = Field(default="mongodb", description="Where chunk signatures are kept: mongodb or local")
+    diff_writes: Optional[bool] = Field(default=False, description="Whether a changed file only writes its added and changed chunks and deletes its removed ones")
+    backfill: Optional[bool] = Field(default=False, description="Whether the first run rebuilds the whole collection in a shadow collection that is swapped in when it completes")
 
 
 
@@ -26,6 +33,7 @@ class Config(BaseModel):
     sync_interval_seconds: int
     source: SourceConfig
     destination: DestinationConfig
+    profile: Optional[bool] = Field(default=False, description="Whether to profile this run of the pipeline")
 
 
 class AppConfig(BaseSettings):
@@ -1,23 +1,38 @@
+import hashlib
+import json
 import os
+import shutil
+import threading
+from collections import OrderedDict
+from copy import copy
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Generator, List
 
-# Import connection configuration classes for each data source
-from unstructured_ingest.v2.interfaces import ProcessorConfig
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
-from unstructured_ingest.v2.processes.chunker import ChunkerConfig
-from unstructured_ingest.v2.processes.connectors.mongodb import (
-    mongodb_destination_entry,
-    MongoDBUploadStagerConfig,
-    MongoDBUploadStager
+# Pipeline and processing modules. Source connectors are imported through
+# util.connectors once a source of their type is configured.
+from unstructured_ingest.v2.interfaces import (
+    ConnectionConfig,
+    FileData,
+    Indexer,
+    IndexerConfig,
+    ProcessorConfig,
 )
+from unstructured_ingest.v2.pipeline.pipeline import Pipeline, PipelineError
+from unstructured_ingest.v2.pipeline.steps.index import IndexStep
+from unstructured_ingest.v2.processes.chunker import Chunker, ChunkerConfig
 
+from util.unstructured_embedder import OnnxEmbedderConfig
 from util.unstructured_mongodb import (
     MongoDBAccessConfig,
     MongoDBConnectionConfig,
     MongoDBUploaderConfig,
+    MongoDBUploadStagerConfig,
+    MongoDBUploadStager,
     MAAPUploader,
 )
 
-from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+from unstructured_ingest.v2.processes.embedder import Embedder
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 
 from mongodb_ingest import CustomMongoDBUploader
@@ -26,8 +41,43 @@ from util.base_configs import Config, DestinationConfig, SourceConfig
 from util.configs.source import SourceConnectionFactory
 from util.configs.indexer import IndexerFactory
 from util.configs.downloader import DownloaderFactory
+from util.connectors import load_source_connector
+from util.checkpoints import CheckpointedDownloadStep
+from util.dedup import ChunkDedupConfig, DedupChunkStep, remove_source
+from util.unstructured_partition import (
+    PageRangePartitioner,
+    PageRangePartitionerConfig,
+    PageRangePartitionStep,
+    PooledPartitioner,
+    PooledPartitionerConfig,
+)
+from util.profiling import profile_job
 from pymongo import MongoClient
 
+WORK_DIR = "./content/temp"
+DEDUP_DIR = "./content/dedup"
+
+# Number of built pipelines kept for reuse by later runs of the same source
+PIPELINE_CACHE_SIZE = 16
+
+
+@dataclass
+class QueuedFilesIndexer(Indexer):
+    """
+    Indexer that yields files claimed from the work queue instead of listing the
+    source. It carries the source indexer's configs so the index step hashes
+    files exactly as a full run would.
+    """
+    connection_config: ConnectionConfig
+    index_config: IndexerConfig
+    file_datas: List[Dict[str, Any]] = field(default_factory=list)
+    connector_type: str = "work_queue"
+
+    def run(self, **kwargs: Any) -> Generator[FileData, None, None]:
+        for file_data in self.file_datas:
+            yield FileData.from_dict(file_data)
+
+
 class PipelineBuilder:
     def __init__(self):
         # TODO: Add default values
@@ -40,18 +90,23 @@ class PipelineBuilder:
         self.stager_config = MongoDBUploadStagerConfig()
         self.chunker_config = None
         self.embedder_config = None
+        self.dedup_config = None
+        self.source_type = None
+        self.work_dir = WORK_DIR
+        self.resume = False
 
 
 
     def configure_source_connection(self, source: SourceConfig) -> 'PipelineBuilder':
         source_type = source.source_type
+        self.source_type = source_type
         credentials = source.credentials or {}
         self.source_connection_config = SourceConnectionFactory.get_source_connection(source_type, credentials)
         return self
 
-    def configure_indexer(self, source: SourceConfig) -> 'PipelineBuilder':
+    def configure_indexer(self, source: SourceConfig, state_key: str = None) -> 'PipelineBuilder':
         source_type = source.source_type
-        self.indexer_config = IndexerFactory.get_indexer_connection(source_type, source.params)
+        self.indexer_config = IndexerFactory.get_indexer_connection(source_type, source.params, state_key)
         return self
 
     def configure_downloader(self, source: SourceConfig) -> 'PipelineBuilder':
@@ -59,8 +114,9 @@ class PipelineBuilder:
         self.downloader_config = DownloaderFactory.get_downloader_connection(source_type, source.params)
         return self
 
-    def configure_destination(self, config: DestinationConfig ) -> 'PipelineBuilder':
-        mongodb_destination_entry.connection_config = MongoDBConnectionConfig
+    def configure_destination(
+        self, config: DestinationConfig, backfill: bool = False, source_key: str = None
+    ) -> 'PipelineBuilder':
         self.destination_connection_config = MongoDBConnectionConfig(
             access_config=MongoDBAccessConfig(uri=config.mongodb_uri),
             collection=config.collection,
@@ -70,32 +126,62 @@ class PipelineBuilder:
             embedding_path=config.embedding_path,
             id_fields=config.id_fields,
             create_md5=config.create_md5 if config.create_md5 else True, # by default, create MD5 hash
+            chunk_fields=config.chunk_fields,
+            files_collection=f"{config.collection}_files" if config.normalize_metadata else None,
+            diff_writes=config.diff_writes,
+            source_key=source_key,
+            shadow_collection=f"{config.collection}_backfill" if backfill else None,
+            shadow_files_collection=(
+                f"{config.collection}_files_backfill" if backfill and config.normalize_metadata else None),
         )
         return self
     
     def configure_uploader(self, config: DestinationConfig) -> 'PipelineBuilder':
-        mongodb_destination_entry.uploader_config = MongoDBUploaderConfig
         self.uploader_config = MongoDBUploaderConfig(batch_size=config.batch_size)
         return self
     
     def configure_stager(self) -> 'PipelineBuilder':
-        mongodb_destination_entry.stager_config = MongoDBUploadStagerConfig
-        self.stager_config = MongoDBUploadStagerConfig()
+        artifact_format = os.getenv("INTERMEDIATE_FORMAT")
+        self.stager_config = MongoDBUploadStagerConfig(
+            **({"artifact_format": artifact_format} if artifact_format else {})
+        )
+        return self
+
+    def configure_dedup(self, config: DestinationConfig, source_key: str) -> 'PipelineBuilder':
+        if config.dedup:
+            # Signatures are shared by every source loading into the destination collection
+            self.dedup_config = ChunkDedupConfig(
+                mode=config.dedup,
+                threshold=config.dedup_threshold,
+                index=config.dedup_index,
+                mongodb_uri=config.mongodb_uri,
+                database=config.database,
+                collection=f"{config.collection}_minhash",
+                local_path=os.path.join(DEDUP_DIR, f"{config.database}.{config.collection}.sqlite"),
+                source=source_key,
+            )
+        return self
+
+    def configure_processor(self, work_dir: str = WORK_DIR, resume: bool = False) -> 'PipelineBuilder':
+        # When resuming, every stage reuses the outputs it already checkpointed in work_dir
+        self.work_dir = work_dir
+        self.resume = resume
         return self
 
     def processor_config(self) -> ProcessorConfig:
         return ProcessorConfig(
-                reprocess=True,
+                reprocess=not self.resume,
                 verbose=True,
                 tqdm=True,
                 num_processes=5,
-                work_dir="./content/temp",
-                re_download=True,
+                work_dir=self.work_dir,
+                re_download=not self.resume,
             )
     
     def partition_config(self) -> PartitionerConfig:
         if os.getenv("RUN_ENV", "local") == "local":
-            return PartitionerConfig(
+            range_size = os.getenv("LOCAL_PDF_PAGE_RANGE_SIZE")
+            return PageRangePartitionerConfig(
                     partition_by_api=False,
                     strategy="hi_res",
                     fields_include=["element_id", "text", "type", "metadata"],
@@ -105,12 +191,18 @@ class PipelineBuilder:
                         "include_page_breaks": True,
                         "ocr_languages": ["eng"]
                     },
+                    **({"pdf_page_range_size": range_size} if range_size else {})
             )
         else:
-            return PartitionerConfig(
+            tunables = {
+                "max_concurrency": os.getenv("UNSTRUCTURED_MAX_CONCURRENCY"),
+                "pdf_page_batch_size": os.getenv("UNSTRUCTURED_PDF_PAGE_BATCH_SIZE"),
+            }
+            return PooledPartitionerConfig(
                     partition_by_api=True,
                     api_key=os.getenv("UNSTRUCTURED_API_KEY"),
                     partition_endpoint=os.getenv("UNSTRUCTURED_URL"),
+                    **{key: value for key, value in tunables.items() if value}
                 )
     
     def configure_chunker_config(self, config: SourceConfig) -> 'PipelineBuilder':
@@ -124,45 +216,265 @@ class PipelineBuilder:
             raise ValueError("Source configuration params not provided")
         return self
     
-    def configure_embedder_config(self) -> 'PipelineBuilder':
-        self.embedder_config = EmbedderConfig(
-                embedding_provider="huggingface",
-                embedding_model_name="all-MiniLM-L6-v2",
-            )
+    def configure_embedder_config(self, config: DestinationConfig = None) -> 'PipelineBuilder':
+        if os.getenv("EMBEDDING_BACKEND", "huggingface") == "onnx":
+            tunables = {
+                "embedding_model_file": os.getenv("EMBEDDING_MODEL_FILE"),
+                "embedding_num_threads": os.getenv("EMBEDDING_NUM_THREADS"),
+                "embedding_batch_size": os.getenv("EMBEDDING_BATCH_SIZE"),
+                "embedding_normalize": os.getenv("EMBEDDING_NORMALIZE"),
+            }
+            self.embedder_config = OnnxEmbedderConfig(
+                    embedding_provider="onnx",
+                    embedding_model_dir=os.getenv("EMBEDDING_MODEL_DIR"),
+                    embedding_dimensions=config.embedding_dimensions if config else None,
+                    **{key: value for key, value in tunables.items() if value}
+                )
+        else:
+            self.embedder_config = OnnxEmbedderConfig(
+                    embedding_provider="huggingface",
+                    embedding_model_name="all-MiniLM-L6-v2",
+                )
         return self
     
+    def build_indexer(self) -> Indexer:
+        indexer = load_source_connector(self.source_type, "indexer")
+        return indexer(
+            index_config=self.indexer_config,
+            connection_config=self.source_connection_config,
+        )
+
     #Build the pipeline
-    def build(self) -> Pipeline:
-        mongodb_destination_entry.uploader = MAAPUploader
-        print(self.stager_config)
-        self.pipeline = Pipeline.from_configs(
-            context= self.processor_config(),
-            indexer_config=self.indexer_config,
-            downloader_config=self.downloader_config,
-            partitioner_config=self.partition_config(),
-            chunker_config=self.chunker_config,
-            embedder_config=self.embedder_config,
-            source_connection_config=self.source_connection_config,
-            destination_connection_config=self.destination_connection_config,
-            stager_config=self.stager_config,
-            uploader_config=self.uploader_config,
+    def build(self) -> 'PipelineBuilder':
+        # Steps are created from our classes directly rather than through
+        # Pipeline.from_configs, which looks them up in unstructured's shared
+        # registries
+        downloader = load_source_connector(self.source_type, "downloader")
+        partition_config = self.partition_config()
+        partitioner = PooledPartitioner if partition_config.partition_by_api else PageRangePartitioner
+        self.pipeline = Pipeline(
+            context=self.processor_config(),
+            indexer=self.build_indexer(),
+            downloader=downloader(
+                # Downloads are kept with the job's other stage outputs
+                download_config=self.downloader_config.model_copy(
+                    update={"download_dir": Path(self.work_dir) / "download"}),
+                connection_config=self.source_connection_config,
+            ),
+            partitioner=partitioner(config=partition_config),
+            chunker=Chunker(config=self.chunker_config) if self.chunker_config else None,
+            embedder=Embedder(config=self.embedder_config) if self.embedder_config else None,
+            stager=MongoDBUploadStager(upload_stager_config=self.stager_config),
+            uploader=MAAPUploader(
+                upload_config=self.uploader_config,
+                connection_config=self.destination_connection_config.model_copy(update={
+                    "embedder_identity": self.embedder_config.identity() if self.embedder_config else None,
+                }),
+            ),
         )
+        self.pipeline.downloader_step = CheckpointedDownloadStep(
+            process=self.pipeline.downloader_step.process,
+            context=self.pipeline.context,
+        )
+        if self.dedup_config and self.pipeline.chunker_step:
+            self.pipeline.chunker_step = DedupChunkStep(
+                process=self.pipeline.chunker_step.process,
+                context=self.pipeline.context,
+                dedup_config=self.dedup_config,
+            )
+        if not partition_config.partition_by_api:
+            self.pipeline.partitioner_step = PageRangePartitionStep(
+                process=self.pipeline.partitioner_step.process,
+                context=self.pipeline.context,
+            )
         return self
-    
-def start_pipeline(config: Config):
+
+
+_pipelines: "OrderedDict[str, Pipeline]" = OrderedDict()
+_pipelines_lock = threading.Lock()
+
+def pipeline_key(config: Config, work_dir: str, resume: bool = False, backfill: bool = False) -> str:
+    """Hash of the normalized source and destination configs and processing options of a pipeline."""
+    state = {
+        "config": config.model_dump(mode="json", include={"source", "destination"}),
+        "work_dir": work_dir,
+        "resume": resume,
+        "backfill": backfill,
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+def get_pipeline(config: Config, work_dir: str, resume: bool = False, backfill: bool = False) -> Pipeline:
+    """
+    Pipeline for a config, built on first use and reused by later runs with the
+    same config, so they skip validating the configs and keep the embedding
+    model and connector pools loaded.
+    """
+    key = pipeline_key(config, work_dir, resume, backfill)
+    with _pipelines_lock:
+        if key in _pipelines:
+            _pipelines.move_to_end(key)
+            return _pipelines[key]
+    pipeline = _configure_builder(config, work_dir, resume, backfill).build().pipeline
+    with _pipelines_lock:
+        _pipelines[key] = pipeline
+        while len(_pipelines) > PIPELINE_CACHE_SIZE:
+            _pipelines.popitem(last=False)
+    return pipeline
+
+def _profiled(pipeline: Pipeline, profile_dir: str) -> Pipeline:
+    """Copy of a cached pipeline whose stager and uploader record allocation snapshots into profile_dir."""
+    pipeline = copy(pipeline)
+    for name in ("stager_step", "uploader_step"):
+        step = copy(getattr(pipeline, name))
+        step.process = copy(step.process)
+        step.process.profile_dir = str(profile_dir)
+        setattr(pipeline, name, step)
+    return pipeline
+
+def _run(pipeline: Pipeline) -> None:
+    try:
+        pipeline.run()
+    finally:
+        # The run's status dict keeps a multiprocessing manager process alive
+        pipeline.context.status = {}
+
+def start_pipeline(config: Config, job_id: str = None, resume: bool = False, backfill: bool = False):
+    if config.profile:
+        with profile_job(WORK_DIR, config.source.source_type) as profile_dir:
+            _run_pipeline(config, job_id, resume, backfill, profile_dir)
+    else:
+        _run_pipeline(config, job_id, resume, backfill)
+
+def source_state_key(config: Config) -> str:
+    """Stable key of a registered source, for state kept between its runs."""
+    source = config.source
+    state = {
+        "source_type": source.source_type,
+        "drive_id": (source.credentials or {}).get("google_drive_folder_id"),
+        "params": source.params,
+        "database": config.destination.database,
+        "collection": config.destination.collection,
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+def commit_source_state(config: Config) -> None:
+    """Make state recorded while indexing a source, such as change tokens, current after a successful run."""
+    if config.source.source_type == "google_drive":
+        from util.unstructured_google_drive import ChangeTokenStore
+        ChangeTokenStore().commit(source_state_key(config))
+
+def remove_source_state(config: Config) -> None:
+    """Remove state kept for a deleted source, such as its chunks' dedup entries."""
+    builder = PipelineBuilder().configure_dedup(config.destination, source_state_key(config))
+    if builder.dedup_config:
+        remove_source(builder.dedup_config)
+
+def _backfill_uploader(config: Config) -> MAAPUploader:
+    builder = PipelineBuilder().configure_destination(config.destination, backfill=True)\
+        .configure_uploader(config.destination)
+    return MAAPUploader(
+        upload_config=builder.uploader_config,
+        connection_config=builder.destination_connection_config,
+    )
+
+def prepare_backfill(config: Config) -> None:
+    """Start a backfill from an empty shadow collection and a full listing of the source."""
+    if config.source.source_type == "google_drive":
+        from util.unstructured_google_drive import ChangeTokenStore
+        ChangeTokenStore().reset(source_state_key(config))
+    _backfill_uploader(config).prepare_shadow()
+
+def swap_in_backfill(config: Config) -> None:
+    """Index a completed backfill's shadow collection and swap it in for the destination collection."""
+    _backfill_uploader(config).swap_in_shadow()
+
+def _configure_builder(config: Config, work_dir: str, resume: bool = False, backfill: bool = False) -> PipelineBuilder:
     source_config = config.source
     destination_config = config.destination
     builder = PipelineBuilder()
-    builder = builder.configure_source_connection(source_config)\
-        .configure_indexer(source_config)\
+    return builder.configure_processor(work_dir, resume)\
+        .configure_source_connection(source_config)\
+        .configure_indexer(source_config, source_state_key(config))\
         .configure_downloader(source_config)\
-        .configure_destination(destination_config)\
+        .configure_destination(destination_config, backfill, source_state_key(config))\
         .configure_uploader(destination_config)\
         .configure_stager()\
+        .configure_dedup(destination_config, source_state_key(config))\
         .configure_chunker_config(source_config)\
-        .configure_embedder_config()
-    pipeline = builder.build().pipeline
-    pipeline.run()
+        .configure_embedder_config(destination_config)
+
+def job_work_dir(job_id: str = None) -> str:
+    # Jobs get their own work dir so their stage checkpoints survive a restart
+    return os.path.join(WORK_DIR, "jobs", job_id) if job_id else WORK_DIR
+
+def remove_job_work_dir(job_id: str) -> None:
+    """Remove the downloads and stage outputs of a job that won't be resumed, local sources are read in place."""
+    shutil.rmtree(job_work_dir(job_id), ignore_errors=True)
+
+def _run_pipeline(
+    config: Config, job_id: str = None, resume: bool = False, backfill: bool = False, profile_dir: str = None
+):
+    work_dir = job_work_dir(job_id)
+    if backfill and not resume:
+        prepare_backfill(config)
+    pipeline = get_pipeline(config, work_dir, resume, backfill)
+    _run(_profiled(pipeline, profile_dir) if profile_dir else pipeline)
+    if backfill:
+        swap_in_backfill(config)
+    commit_source_state(config)
+    if job_id:
+        # The run completed, its checkpoints are no longer needed
+        remove_job_work_dir(job_id)
+
+def index_source(config: Config) -> List[Dict[str, Any]]:
+    """List the files of a source without processing them, as serialized FileData."""
+    builder = PipelineBuilder()
+    builder.configure_source_connection(config.source)\
+        .configure_indexer(config.source, source_state_key(config))
+    indexer = builder.build_indexer()
+    indexer.precheck()
+    return [file_data.to_dict() for file_data in indexer.run()]
+
+def _failed_files(pipeline: Pipeline) -> Dict[str, str]:
+    """Errors of the files that failed in a run, by file identifier."""
+    failed = {}
+    for file_data_path, errors in pipeline.context.status.items():
+        try:
+            identifier = FileData.from_file(path=file_data_path).identifier
+        except Exception:
+            raise PipelineError(f"Could not tell which file failed: {dict(errors)}")
+        failed[identifier] = "; ".join(f"[{step}] {error}" for step, error in errors.items())
+    return failed
+
+def start_pipeline_for_files(
+    config: Config, file_datas: List[Dict[str, Any]], work_dir: str, backfill: bool = False
+) -> Dict[str, str]:
+    """
+    Run download through upload for files previously listed by index_source.
+    Returns the errors of the files that failed, by identifier.
+    """
+    # A shallow copy with its own index step leaves the cached pipeline as it was
+    pipeline = copy(get_pipeline(config, work_dir, backfill=backfill))
+    indexer = pipeline.indexer_step.process
+    pipeline.indexer_step = IndexStep(
+        process=QueuedFilesIndexer(
+            connection_config=indexer.connection_config,
+            index_config=indexer.index_config,
+            file_datas=file_datas,
+        ),
+        context=pipeline.context,
+    )
+    try:
+        try:
+            pipeline.run()
+        except PipelineError:
+            # Raised when any file failed, they are reported one by one instead
+            if not pipeline.context.status:
+                raise
+        return _failed_files(pipeline)
+    finally:
+        pipeline.context.status = {}
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 if __name__=="__main__":
     # Example test case for PipelineBuilder
@@ -188,7 +500,8 @@ if __name__=="__main__":
     builder.configure_downloader(source_config)
     builder.configure_destination(destination_config)
     builder.configure_uploader(destination_config)
+    builder.configure_stager()
     builder.configure_chunker_config(source_config)
-    builder.configure_embedder_config()
+    builder.configure_embedder_config(destination_config)
     builder.build()
     builder.pipeline.run()  # Uncomment to run the pipeline
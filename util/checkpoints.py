@@ -0,0 +1,47 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from unstructured_ingest.v2.interfaces import FileData
+from unstructured_ingest.v2.pipeline.steps.download import DownloadStep
+
+
+def source_mtime(file_data: FileData) -> Optional[float]:
+    """The source file's modification time recorded by the indexer, if it is a timestamp."""
+    try:
+        return float(file_data.metadata.date_modified)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class CheckpointedDownloadStep(DownloadStep):
+    """
+    Download step that stamps each download with its source file's modification
+    time, so a resumed run reuses the download and the stage outputs made from
+    it. Upstream compares the source's time with the download's own mtime,
+    which is always later, and downloads and reprocesses every file again.
+    """
+
+    def should_download(self, file_data: FileData, file_data_path: str) -> bool:
+        if self.context.re_download:
+            return True
+        download_path = self.process.get_download_path(file_data=file_data)
+        if not download_path or not download_path.exists():
+            return True
+        modified = source_mtime(file_data)
+        if download_path.is_file() and modified is not None and abs(download_path.stat().st_mtime - modified) > 1e-3:
+            # The source file changed since it was downloaded
+            file_data.reprocess = True
+            file_data.to_file(path=file_data_path)
+            return True
+        return False
+
+    def update_file_data(self, file_data: FileData, file_data_path: Path, download_path: Path) -> None:
+        download_path = Path(download_path)
+        modified = source_mtime(file_data)
+        # Local sources are read in place and already carry their own mtime
+        if modified is not None and download_path.is_file() and download_path.stat().st_mtime != modified:
+            os.utime(download_path, (download_path.stat().st_atime, modified))
+        super().update_file_data(file_data=file_data, file_data_path=file_data_path, download_path=download_path)
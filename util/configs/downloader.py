@@ -1,18 +1,6 @@
 from traceback import print_exc
 
-from unstructured_ingest.v2.processes.connectors.local import (
-    LocalDownloaderConfig
-)
-
-from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
-    S3DownloaderConfig
-)
-
-from unstructured_ingest.v2.processes.connectors.google_drive import (
-    GoogleDriveDownloaderConfig
-)
-
-import os
+from util.connectors import load_source_connector
 
 class DownloaderFactory:
     @staticmethod
@@ -20,12 +8,22 @@ class DownloaderFactory:
         # if params is None:
         #     raise ValueError("Params cannot be None")
         try:
+            # Connector modules are imported here, on first use of their source type
+            downloader_config = load_source_connector(source_type, "downloader_config")
             if source_type == "local":
-                return LocalDownloaderConfig()
+                return downloader_config()
             elif source_type == "s3":
-                return S3DownloaderConfig()
+                params = params or {}
+                tunables = ["download_concurrency", "multipart_threshold", "part_size", "part_concurrency"]
+                return downloader_config(
+                    **{key: params[key] for key in tunables if key in params}
+                )
             elif source_type == "google_drive":
-                return GoogleDriveDownloaderConfig()
+                params = params or {}
+                tunables = ["download_concurrency", "num_retries"]
+                return downloader_config(
+                    **{key: params[key] for key in tunables if key in params}
+                )
             else:
                 raise ValueError(f"Unsupported source type: {source_type}")
         except Exception as e:
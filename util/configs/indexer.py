@@ -1,29 +1,40 @@
-from unstructured_ingest.v2.processes.connectors.local import (
-    LocalIndexerConfig
-)
-
-from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
-    S3IndexerConfig
-)
-
-from unstructured_ingest.v2.processes.connectors.google_drive import (
-    GoogleDriveIndexerConfig,
-)
-
 from traceback import print_exc
 
+from util.connectors import load_source_connector
+
 class IndexerFactory:
     @staticmethod
-    def get_indexer_connection(source_type, params=None):
+    def get_indexer_connection(source_type, params=None, state_key=None):
         # if params is None:
             # raise ValueError("Params cannot be None")        
         try:
+            # Connector modules are imported here, on first use of their source type
+            indexer_config = load_source_connector(source_type, "indexer_config")
             if source_type == "local":
-                return LocalIndexerConfig()
+                globs = {
+                    key: params[key].split(",")
+                    for key in ["file_glob", "exclude_glob"] if params.get(key)
+                }
+                return indexer_config(
+                    input_path=params.get("input_path") or params.get("remote_url"),
+                    recursive=params.get("recursive", False),
+                    **globs
+                )
             elif source_type == "s3":
-                return S3IndexerConfig(remote_url=params.get("remote_url"))
+                tunables = ["recursive", "listing_concurrency", "shard_depth"]
+                return indexer_config(
+                    remote_url=params.get("remote_url"),
+                    **{key: params[key] for key in tunables if key in params}
+                )
             elif source_type == "google_drive":
-                return GoogleDriveIndexerConfig()
+                params = params or {}
+                extensions = params.get("extensions")
+                return indexer_config(
+                    recursive=params.get("recursive", False),
+                    extensions=extensions.split(",") if extensions else None,
+                    # Sources opt out of incremental sync with "incremental": "false"
+                    state_key=state_key if str(params.get("incremental", "true")).lower() == "true" else None,
+                )
             else:
                 raise ValueError(f"Unsupported source type: {source_type}")
         except Exception as e:
@@ -1,38 +1,33 @@
-from unstructured_ingest.v2.processes.connectors.local import (
-    LocalConnectionConfig
-)
-
-from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
-    S3AccessConfig,
-    S3ConnectionConfig
-)
-
-from unstructured_ingest.v2.processes.connectors.google_drive import (
-    GoogleDriveConnectionConfig,
-    GoogleDriveAccessConfig
-)
+from util.connectors import load_source_connector
 
 class SourceConnectionFactory:
     @staticmethod
     def get_source_connection(source_type, credentials=None):
+        # Connector modules are imported here, on first use of their source type
+        connection_config = load_source_connector(source_type, "connection_config")
         if source_type == "local":
-            return LocalConnectionConfig()
-        elif source_type == "s3":
+            return connection_config()
+        access_config = load_source_connector(source_type, "access_config")
+        if source_type == "s3":
             if credentials:
-                access_config = S3AccessConfig(
+                access = access_config(
                     key=credentials.get("aws_access_key_id"),
                     secret=credentials.get("aws_secret_access_key"),
                     token=credentials.get("aws_session_token")
                 )
             else:
-                access_config = S3AccessConfig()
-            return S3ConnectionConfig(
-                access_config=access_config
+                access = access_config()
+            return connection_config(
+                access_config=access,
+                # Allows pointing at S3 compatible stores such as a local moto server
+                endpoint_url=(credentials or {}).get("endpoint_url")
             )
         elif source_type == "google_drive":
-            return GoogleDriveConnectionConfig(
-                access_config=GoogleDriveAccessConfig(service_account_key=credentials.get("gcp_service_account_key_string")),
-                drive_id=credentials.get("google_drive_folder_id")
+            return connection_config(
+                access_config=access_config(service_account_key=credentials.get("gcp_service_account_key_string")),
+                drive_id=credentials.get("google_drive_folder_id"),
+                # Allows pointing at a local fake of the Drive API
+                api_endpoint=credentials.get("api_endpoint")
             )
 
         else:
@@ -0,0 +1,48 @@
+import importlib
+from typing import Any, Dict
+
+# Source connectors by source_type. Each value names, as "module:attribute",
+# the classes the pipeline uses for the source, ours wherever we replace
+# unstructured's. Nothing is imported until a source of that type is used,
+# since importing any unstructured connector loads all of them.
+SOURCE_CONNECTORS: Dict[str, Dict[str, str]] = {
+    "local": {
+        "connection_config": "unstructured_ingest.v2.processes.connectors.local:LocalConnectionConfig",
+        "indexer": "util.unstructured_local:ScanningLocalIndexer",
+        "indexer_config": "util.unstructured_local:ScanningLocalIndexerConfig",
+        "downloader": "unstructured_ingest.v2.processes.connectors.local:LocalDownloader",
+        "downloader_config": "unstructured_ingest.v2.processes.connectors.local:LocalDownloaderConfig",
+    },
+    "s3": {
+        "connection_config": "unstructured_ingest.v2.processes.connectors.fsspec.s3:S3ConnectionConfig",
+        "access_config": "unstructured_ingest.v2.processes.connectors.fsspec.s3:S3AccessConfig",
+        "indexer": "util.unstructured_s3:ParallelS3Indexer",
+        "indexer_config": "util.unstructured_s3:ParallelS3IndexerConfig",
+        "downloader": "util.unstructured_s3:ParallelS3Downloader",
+        "downloader_config": "util.unstructured_s3:ParallelS3DownloaderConfig",
+    },
+    "google_drive": {
+        "connection_config": "util.unstructured_google_drive:GoogleDriveEndpointConnectionConfig",
+        "access_config": "unstructured_ingest.v2.processes.connectors.google_drive:GoogleDriveAccessConfig",
+        "indexer": "util.unstructured_google_drive:IncrementalGoogleDriveIndexer",
+        "indexer_config": "util.unstructured_google_drive:IncrementalGoogleDriveIndexerConfig",
+        "downloader": "util.unstructured_google_drive:ConcurrentGoogleDriveDownloader",
+        "downloader_config": "util.unstructured_google_drive:ConcurrentGoogleDriveDownloaderConfig",
+    },
+}
+
+
+def load(path: str) -> Any:
+    """Import the attribute named by a "module:attribute" path."""
+    module, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module), attribute)
+
+
+def load_source_connector(source_type: str, name: str) -> Any:
+    """Import one class of a source type's connector, e.g. its "indexer_config"."""
+    try:
+        connector = SOURCE_CONNECTORS[source_type]
+    except KeyError:
+        raise ValueError(f"Unsupported source type: {source_type}")
+    return load(connector[name])
+
@@ -0,0 +1,327 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Literal, Optional, Tuple
+
+import certifi
+import numpy as np
+from pydantic import BaseModel, Field, model_validator
+from pymongo import MongoClient, UpdateOne
+
+from unstructured_ingest.v2.interfaces import FileData
+from unstructured_ingest.v2.logger import logger
+from unstructured_ingest.v2.pipeline.steps.chunk import ChunkStep, ChunkStepResponse
+
+MERSENNE_PRIME = (1 << 61) - 1
+SHINGLE_WORDS = 5
+# Characters MongoDB doesn't allow in database names
+INVALID_DATABASE_CHARS = set('/\\. "$\0')
+
+
+class ChunkDedupConfig(BaseModel):
+    mode: Literal["drop", "mark"] = Field(
+        default="drop", description="drop near-duplicate chunks and link them to the canonical chunk, "
+                                    "or mark them with metadata.duplicate_of")
+    threshold: float = Field(
+        default=0.85, gt=0, le=1,
+        description="Estimated Jaccard similarity of word shingles above which chunks are duplicates")
+    num_perm: int = Field(default=128, gt=0, description="Number of MinHash permutations")
+    bands: int = Field(default=16, gt=0, description="Number of LSH bands, num_perm must be a multiple of it")
+    index: Literal["mongodb", "local"] = Field(
+        default="mongodb", description="Where signatures are kept: mongodb, shared by all replicas, or local")
+    mongodb_uri: Optional[str] = Field(default=None, description="MongoDB holding the signature collection")
+    database: Optional[str] = None
+    collection: Optional[str] = Field(default=None, description="Signature collection")
+    local_path: Optional[str] = Field(default=None, description="SQLite file of the local index")
+    source: Optional[str] = Field(
+        default=None, description="Key of the registered source whose chunks are checked, "
+                                  "chunks are only compared with other sources' chunks")
+
+    @model_validator(mode="after")
+    def check_index_location(self) -> "ChunkDedupConfig":
+        if self.num_perm % self.bands:
+            raise ValueError(f"num_perm ({self.num_perm}) must be a multiple of bands ({self.bands})")
+        if self.index == "local":
+            if not self.local_path:
+                raise ValueError("the local dedup index needs local_path")
+            return self
+        if not (self.mongodb_uri and self.database and self.collection):
+            raise ValueError("the mongodb dedup index needs mongodb_uri, database and collection")
+        if INVALID_DATABASE_CHARS & set(self.database):
+            raise ValueError(f"invalid database name for the dedup index: {self.database!r}")
+        if "$" in self.collection or "\0" in self.collection or self.collection.startswith("system."):
+            raise ValueError(f"invalid collection name for the dedup index: {self.collection!r}")
+        return self
+
+
+class MinHashLSH:
+    """MinHash signatures of word shingles, banded for locality sensitive lookups."""
+
+    def __init__(self, num_perm: int = 128, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.RandomState(seed)
+        # Below 2**31 so a * hash + b, with 32-bit hashes, can't overflow uint64
+        self._a = rng.randint(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 31, size=num_perm, dtype=np.uint64)
+
+    @staticmethod
+    def shingles(text: str) -> set:
+        words = re.sub(r"\W+", " ", text.lower()).split()
+        if len(words) <= SHINGLE_WORDS:
+            return {" ".join(words)}
+        return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in self.shingles(text)), dtype=np.uint64)
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME
+        return (permuted.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+    def band_keys(self, signature: np.ndarray) -> List[str]:
+        keys = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows:(band + 1) * self.rows]
+            keys.append(f"{band}:{hashlib.blake2b(rows.tobytes(), digest_size=8).hexdigest()}")
+        return keys
+
+    @staticmethod
+    def similarity(a: np.ndarray, b: np.ndarray) -> float:
+        return float(np.mean(a == b))
+
+
+class MongoDedupIndex:
+    """Chunk signatures in a MongoDB collection, looked up by band key."""
+
+    def __init__(self, config: ChunkDedupConfig):
+        client = MongoClient(config.mongodb_uri, tlsCAFile=certifi.where())
+        self.collection = client[config.database][config.collection]
+        self.collection.create_index("bands")
+        self.collection.create_index([("source", 1), ("file", 1)])
+
+    def candidates(self, band_keys: List[str], source: str) -> List[Tuple[str, str, bytes]]:
+        cursor = self.collection.find(
+            {"bands": {"$in": band_keys}, "source": {"$ne": source}}, {"element_id": 1, "signature": 1})
+        return [(entry["_id"], entry["element_id"], entry["signature"]) for entry in cursor]
+
+    def add(self, entries: List[Dict[str, Any]]) -> None:
+        if entries:
+            self.collection.bulk_write([
+                UpdateOne({"_id": entry["_id"]}, {"$set": entry}, upsert=True) for entry in entries
+            ], ordered=False)
+
+    def link(self, links: List[Tuple[str, str, str]]) -> None:
+        if links:
+            self.collection.bulk_write([
+                UpdateOne({"_id": canonical_id},
+                          {"$addToSet": {"duplicates": {"element_id": element_id, "source": source}}})
+                for canonical_id, element_id, source in links
+            ], ordered=False)
+
+    def remove(self, source: str, file: Optional[str] = None, keep: Iterable[str] = ()) -> List[str]:
+        """Remove a source's entries, or one file's, and return the sources of the duplicates linked to them."""
+        query: Dict[str, Any] = {"source": source}
+        if file is not None:
+            query["file"] = file
+        keep = list(keep)
+        if keep:
+            query["_id"] = {"$nin": keep}
+        orphaned = {
+            duplicate["source"]
+            for entry in self.collection.find({**query, "duplicates.0": {"$exists": True}}, {"duplicates": 1})
+            for duplicate in entry["duplicates"]
+        }
+        self.collection.delete_many(query)
+        return sorted(orphaned)
+
+
+class LocalDedupIndex:
+    """Chunk signatures in a SQLite file, for single replica deployments."""
+
+    def __init__(self, config: ChunkDedupConfig):
+        Path(config.local_path).parent.mkdir(parents=True, exist_ok=True)
+        # Pool workers write concurrently, SQLite serializes them
+        self.db = sqlite3.connect(config.local_path, timeout=60)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS chunks "
+                            "(id TEXT PRIMARY KEY, element_id TEXT, source TEXT, file TEXT, signature BLOB)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS chunks_file ON chunks (source, file)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS bands (band TEXT, chunk_id TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS bands_band ON bands (band)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS duplicates "
+                            "(canonical_id TEXT, element_id TEXT, source TEXT, "
+                            "PRIMARY KEY (canonical_id, element_id))")
+
+    def candidates(self, band_keys: List[str], source: str) -> List[Tuple[str, str, bytes]]:
+        placeholders = ",".join("?" * len(band_keys))
+        return self.db.execute(
+            f"SELECT DISTINCT c.id, c.element_id, c.signature FROM bands b JOIN chunks c ON c.id = b.chunk_id "
+            f"WHERE b.band IN ({placeholders}) AND c.source != ?", [*band_keys, source]).fetchall()
+
+    def add(self, entries: List[Dict[str, Any]]) -> None:
+        with self.db:
+            for entry in entries:
+                self.db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+                                (entry["_id"], entry["element_id"], entry["source"], entry["file"],
+                                 entry["signature"]))
+                self.db.execute("DELETE FROM bands WHERE chunk_id = ?", (entry["_id"],))
+                self.db.executemany("INSERT INTO bands VALUES (?, ?)",
+                                    [(band, entry["_id"]) for band in entry["bands"]])
+
+    def link(self, links: List[Tuple[str, str, str]]) -> None:
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO duplicates VALUES (?, ?, ?)", links)
+
+    def remove(self, source: str, file: Optional[str] = None, keep: Iterable[str] = ()) -> List[str]:
+        """Remove a source's entries, or one file's, and return the sources of the duplicates linked to them."""
+        where, params = "source = ?", [source]
+        if file is not None:
+            where, params = f"{where} AND file = ?", [*params, file]
+        keep = set(keep)
+        orphaned = set()
+        with self.db:
+            ids = [row[0] for row in self.db.execute(f"SELECT id FROM chunks WHERE {where}", params)
+                   if row[0] not in keep]
+            # Within SQLite's limit on query parameters
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                orphaned.update(row[0] for row in self.db.execute(
+                    f"SELECT DISTINCT source FROM duplicates WHERE canonical_id IN ({placeholders})", batch))
+                self.db.execute(f"DELETE FROM duplicates WHERE canonical_id IN ({placeholders})", batch)
+                self.db.execute(f"DELETE FROM bands WHERE chunk_id IN ({placeholders})", batch)
+                self.db.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+        return sorted(orphaned)
+
+
+DEDUP_INDEXES = {
+    "mongodb": MongoDedupIndex,
+    "local": LocalDedupIndex,
+}
+
+
+def relist_sources(sources: List[str]) -> None:
+    """
+    Chunks dropped as duplicates of a removed entry are stored nowhere else.
+    Their sources list all of their files on their next run, which checks
+    those chunks again and loads them if they have no duplicate left.
+    """
+    if not sources:
+        return
+    # Only incremental sources keep state that skips unchanged files
+    from util.unstructured_google_drive import ChangeTokenStore
+    store = ChangeTokenStore()
+    for source in sources:
+        logger.info(f"Chunks dropped from source {source} lost their canonical chunk, relisting it")
+        store.reset(source)
+
+
+def remove_source(config: ChunkDedupConfig) -> None:
+    """Remove the index entries of a deleted source."""
+    relist_sources(DEDUP_INDEXES[config.index](config).remove(config.source))
+
+
+@dataclass
+class DedupChunkStep(ChunkStep):
+    """
+    Chunk step that checks every new chunk against the MinHash LSH index of the
+    chunks already ingested from other sources into the same destination.
+    Near-duplicates are dropped and recorded on the canonical chunk's index
+    entry, or kept and marked with metadata.duplicate_of, before they reach
+    the embedder. Other chunks become canonical for later files, replacing
+    the entries of the file's previous chunks.
+    """
+    dedup_config: Optional[ChunkDedupConfig] = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        if self.dedup_config is None:
+            raise ValueError("Chunk dedup needs a dedup config")
+        if not self.dedup_config.source:
+            raise ValueError("Chunk dedup needs the key of the registered source")
+        self._lsh = MinHashLSH(num_perm=self.dedup_config.num_perm, bands=self.dedup_config.bands)
+        self._index = None
+        self._index_pid = None
+
+    def __getstate__(self):
+        # Index connections don't pickle, pool workers open their own
+        state = self.__dict__.copy()
+        state["_index"] = None
+        return state
+
+    def _get_index(self):
+        if self._index is None or self._index_pid != os.getpid():
+            self._index = DEDUP_INDEXES[self.dedup_config.index](self.dedup_config)
+            self._index_pid = os.getpid()
+        return self._index
+
+    def _find_canonical(
+        self, signature: np.ndarray, band_keys: List[str], source: str
+    ) -> Optional[Tuple[str, str]]:
+        """Index entry id and element id of the most similar chunk of another source, if any."""
+        best, best_similarity = None, self.dedup_config.threshold
+        for entry_id, element_id, stored in self._get_index().candidates(band_keys, source):
+            similarity = self._lsh.similarity(signature, np.frombuffer(stored, dtype=np.uint32))
+            if similarity >= best_similarity:
+                best, best_similarity = (entry_id, element_id), similarity
+        return best
+
+    def deduplicate(self, chunks: List[dict], file: str) -> List[dict]:
+        source = self.dedup_config.source
+        kept, entries, links = [], [], []
+        for chunk in chunks:
+            text = chunk.get("text")
+            if not text:
+                kept.append(chunk)
+                continue
+            signature = self._lsh.signature(text)
+            band_keys = self._lsh.band_keys(signature)
+            canonical = self._find_canonical(signature, band_keys, source)
+            if canonical is None:
+                entries.append({
+                    # Stable across runs, so re-chunking an unchanged file keeps its entries and their links
+                    "_id": f"{source}:{file}:{hashlib.sha1(text.encode()).hexdigest()}",
+                    "element_id": chunk["element_id"],
+                    "source": source,
+                    "file": file,
+                    "signature": signature.tobytes(),
+                    "bands": band_keys,
+                })
+            elif self.dedup_config.mode == "drop":
+                links.append((canonical[0], chunk["element_id"], source))
+                continue
+            else:
+                chunk.setdefault("metadata", {})["duplicate_of"] = canonical[1]
+            kept.append(chunk)
+        index = self._get_index()
+        # Entries of chunks the file no longer has, or that are now duplicates themselves
+        relist_sources(index.remove(source, file, keep=[entry["_id"] for entry in entries]))
+        index.add(entries)
+        index.link(links)
+        if len(entries) < len(chunks):
+            logger.info(f"{len(chunks) - len(entries)} of {len(chunks)} chunks of {file} "
+                        f"are near-duplicates of other sources' chunks")
+        return kept
+
+    async def _run_async(self, fn: Any, path: str, file_data_path: str, **kwargs) -> ChunkStepResponse:
+        file_data = FileData.from_file(path=file_data_path)
+        output_filepath = self.get_output_filepath(filename=Path(path))
+        # Chunk outputs reused from a previous attempt were deduplicated already
+        deduplicate = self.should_chunk(filepath=output_filepath, file_data=file_data)
+        response = await super()._run_async(fn=fn, path=path, file_data_path=file_data_path, **kwargs)
+        if deduplicate:
+            with open(response["path"]) as f:
+                chunks = json.load(f)
+            self._save_output(
+                output_filepath=response["path"],
+                chunked_content=self.deduplicate(chunks, file=file_data.identifier),
+            )
+        return response
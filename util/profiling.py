@@ -0,0 +1,153 @@
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Generator, Optional
+
+from unstructured_ingest.v2.logger import logger
+
+# Profile directories of the threads running a profiled job. Pool workers
+# forked by one of them write their own samples into its directory, other
+# pipelines running in the same process are not profiled.
+_profiled_threads: Dict[int, str] = {}
+
+
+class StackSampler:
+    """
+    Periodically samples the call stack of a single thread and writes the
+    aggregated samples as folded stacks (``frame;frame;frame count``), the
+    input format of flamegraph.pl, speedscope and inferno.
+
+    Samples are flushed to disk every ``flush_interval`` seconds as well as on
+    stop, because pool workers are terminated without running exit handlers.
+    """
+
+    def __init__(self, output_path: Path, thread_id: Optional[int] = None,
+                 interval: float = 0.01, flush_interval: float = 5.0):
+        self.output_path = Path(output_path)
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.samples = Counter()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> "StackSampler":
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self._run, name="maap-stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            lines = [f"{stack} {count}" for stack, count in self.samples.items()]
+        with open(self.output_path, "w") as f:
+            f.write("\n".join(lines))
+
+    def _run(self) -> None:
+        last_flush = time.monotonic()
+        while not self._stop_event.wait(self.interval):
+            self._sample()
+            if time.monotonic() - last_flush > self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def _sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        with self._lock:
+            self.samples[";".join(reversed(stack))] += 1
+
+
+_worker_sampler: Optional[StackSampler] = None
+
+
+def _after_fork_in_child() -> None:
+    # The parent's sampler thread does not survive the fork. The forking thread
+    # does, under the same ident, so a worker forked by a profiled job finds
+    # the job's directory.
+    global _worker_sampler
+    _worker_sampler = None
+    profile_dir = _profiled_threads.get(threading.get_ident())
+    _profiled_threads.clear()
+    if profile_dir:
+        _worker_sampler = StackSampler(Path(profile_dir) / f"worker-{os.getpid()}.folded")
+        _worker_sampler.start()
+
+
+# Pool workers are forked on Linux, with the spawn start method they are not sampled
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def profile_allocations(name: str) -> Callable:
+    """
+    Decorator for the run method of a pipeline process, recording a tracemalloc
+    snapshot of each call when the process has a ``profile_dir``. Snapshots can
+    be inspected with ``tracemalloc.Snapshot.load``.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+            profile_dir = getattr(self, "profile_dir", None)
+            if not profile_dir:
+                return func(self, *args, **kwargs)
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start(25)
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                snapshot_path = Path(profile_dir) / (
+                    f"{name}-{os.getpid()}-{time.time_ns()}.tracemalloc")
+                tracemalloc.take_snapshot().dump(str(snapshot_path))
+                # Tracing slows every allocation, leave the process as it was
+                if started:
+                    tracemalloc.stop()
+                if _worker_sampler is not None:
+                    _worker_sampler.flush()
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile_job(work_dir: str, job_name: str) -> Generator[Path, None, None]:
+    """
+    Profile a single pipeline run. The calling thread and every worker process
+    it forks while the context is active write folded stacks under
+    ``<work_dir>/profiles/<job_name>-<timestamp>``, the yielded directory.
+    Pass it on to the stager and uploader as their ``profile_dir`` for
+    allocation snapshots.
+    """
+    profile_dir = Path(work_dir) / "profiles" / (
+        f"{job_name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    thread_id = threading.get_ident()
+    _profiled_threads[thread_id] = str(profile_dir.resolve())
+    sampler = StackSampler(profile_dir / "main.folded", thread_id=thread_id).start()
+    logger.info(f"Profiling job {job_name}, writing output to {profile_dir}")
+    try:
+        yield profile_dir
+    finally:
+        sampler.stop()
+        _profiled_threads.pop(thread_id, None)
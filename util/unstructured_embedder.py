@@ -0,0 +1,184 @@
+import json
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+from pydantic import Field
+
+from unstructured_ingest.embed.interfaces import BaseEmbeddingEncoder, EmbeddingConfig
+from unstructured_ingest.utils.dep_check import requires_dependencies
+from unstructured_ingest.v2.processes.embedder import EmbedderConfig
+
+if TYPE_CHECKING:
+    from onnxruntime import InferenceSession
+    from tokenizers import Tokenizer
+
+
+@requires_dependencies(["onnxruntime"])
+@lru_cache(maxsize=4)
+def load_session(model_path: str, num_threads: int, pid: int) -> "InferenceSession":
+    """
+    One session per model and process, shared by every file the process embeds.
+    Keyed by pid as well, since a session's thread pool doesn't survive a fork.
+    """
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+@requires_dependencies(["tokenizers"])
+@lru_cache(maxsize=4)
+def load_tokenizer(tokenizer_path: str, max_length: int, pid: int) -> "Tokenizer":
+    from tokenizers import Tokenizer
+
+    tokenizer = Tokenizer.from_file(tokenizer_path)
+    tokenizer.enable_truncation(max_length=max_length)
+    # Without a fixed length, each batch is padded to its longest text only
+    tokenizer.enable_padding()
+    return tokenizer
+
+
+def model_normalizes(model_dir: str) -> bool:
+    """
+    Whether the model's sentence-transformers pipeline ends with a Normalize
+    module, as listed in the modules.json exported next to it. Without one,
+    embeddings are normalized like the default all-MiniLM-L6-v2 model's.
+    """
+    modules_path = Path(model_dir) / "modules.json"
+    if not modules_path.exists():
+        return True
+    with open(modules_path) as f:
+        return any(module.get("type", "").endswith(".Normalize") for module in json.load(f))
+
+
+@requires_dependencies(["onnxruntime"])
+def quantize_model(model_dir: str, model_file: str = "model.onnx",
+                   quantized_file: str = "model_quantized.onnx") -> Path:
+    """Write an int8, dynamically quantized copy of an exported fp32 model."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized_path = Path(model_dir) / quantized_file
+    quantize_dynamic(Path(model_dir) / model_file, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+class OnnxEmbeddingConfig(EmbeddingConfig):
+    model_dir: str = Field(description="Local directory with the ONNX model and its tokenizer.json")
+    model_file: str = Field(default="model_quantized.onnx", description="Model file in model_dir")
+    num_threads: int = Field(default=1, description="Threads used by each embedding process")
+    batch_size: int = Field(default=32, description="Number of texts embedded per model run")
+    max_length: int = Field(default=256, description="Tokens per text, longer texts are truncated")
+    dimensions: Optional[int] = Field(default=None, description="Expected size of the embeddings")
+    normalize: Optional[bool] = Field(
+        default=None, description="Whether to scale embeddings to unit length, as the model does if unset")
+
+
+@dataclass
+class OnnxEmbeddingEncoder(BaseEmbeddingEncoder):
+    """
+    Sentence embeddings from an exported ONNX transformer on the CPU, mean pooled
+    over the attention mask as sentence-transformers does. Texts are sorted by
+    length before batching so that each batch is padded as little as possible.
+    The model and tokenizer are read from model_dir, nothing is downloaded.
+    """
+    config: OnnxEmbeddingConfig
+
+    def __post_init__(self):
+        self._normalize = (
+            model_normalizes(self.config.model_dir) if self.config.normalize is None else self.config.normalize)
+
+    def _session(self) -> "InferenceSession":
+        return load_session(str(Path(self.config.model_dir) / self.config.model_file), self.config.num_threads, os.getpid())
+
+    def _tokenizer(self) -> "Tokenizer":
+        return load_tokenizer(str(Path(self.config.model_dir) / "tokenizer.json"), self.config.max_length, os.getpid())
+
+    def initialize(self):
+        dimensions = len(self.embed_query(query="Q"))
+        if self.config.dimensions and dimensions != self.config.dimensions:
+            raise ValueError(
+                f"model in {self.config.model_dir} produces {dimensions} dimensional embeddings, "
+                f"the destination expects {self.config.dimensions}")
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        session = self._session()
+        encodings = self._tokenizer().encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        input_names = {i.name for i in session.get_inputs()}
+        if "token_type_ids" in input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+        output = session.run(None, {name: feed for name, feed in feeds.items() if name in input_names})[0]
+        if output.ndim == 3:
+            mask = attention_mask[:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self._normalize:
+            output = output / np.clip(np.linalg.norm(output, axis=1, keepdims=True), 1e-12, None)
+        return output.astype(np.float32)
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        for start in range(0, len(order), self.config.batch_size):
+            batch = order[start:start + self.config.batch_size]
+            for i, embedding in zip(batch, self._embed_batch([texts[i] for i in batch])):
+                embeddings[i] = embedding.tolist()
+        return embeddings
+
+    def embed_query(self, query: str) -> List[float]:
+        return self._embed_documents([query])[0]
+
+    def embed_documents(self, elements: List[dict]) -> List[dict]:
+        embeddings = self._embed_documents([e.get("text", "") for e in elements])
+        return self._add_embeddings_to_elements(elements, embeddings)
+
+
+class OnnxEmbedderConfig(EmbedderConfig):
+    embedding_provider: Optional[str] = Field(
+        default=None, description="onnx, or one of unstructured's embedding providers")
+    embedding_model_dir: Optional[str] = Field(
+        default=None, description="Local directory of the ONNX model")
+    embedding_model_file: str = Field(default="model_quantized.onnx")
+    embedding_num_threads: int = Field(default=1, description="Threads used by each embedding process")
+    embedding_batch_size: int = Field(default=32)
+    embedding_dimensions: Optional[int] = Field(default=None)
+    embedding_normalize: Optional[bool] = Field(
+        default=None, description="Whether to scale embeddings to unit length, as the model does if unset")
+
+    def normalizes(self) -> Optional[bool]:
+        if self.embedding_normalize is not None or not self.embedding_model_dir:
+            return self.embedding_normalize
+        return model_normalizes(self.embedding_model_dir)
+
+    def identity(self) -> str:
+        """The settings that determine the embeddings, not how fast they are computed."""
+        return json.dumps({
+            "provider": self.embedding_provider,
+            "model_name": self.embedding_model_name,
+            "model_dir": self.embedding_model_dir,
+            "model_file": self.embedding_model_file,
+            "dimensions": self.embedding_dimensions,
+            "normalize": self.normalizes(),
+        }, sort_keys=True)
+
+    def get_embedder(self) -> BaseEmbeddingEncoder:
+        if self.embedding_provider != "onnx":
+            return super().get_embedder()
+        return OnnxEmbeddingEncoder(
+            config=OnnxEmbeddingConfig(
+                model_dir=self.embedding_model_dir,
+                model_file=self.embedding_model_file,
+                num_threads=self.embedding_num_threads,
+                batch_size=self.embedding_batch_size,
+                dimensions=self.embedding_dimensions,
+                normalize=self.normalizes(),
+            )
+        )
@@ -0,0 +1,61 @@
+import os
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Generator, List, Optional
+
+from pydantic import Field
+
+from unstructured_ingest.v2.processes.connectors.local import (
+    LocalIndexer,
+    LocalIndexerConfig,
+)
+
+
+class ScanningLocalIndexerConfig(LocalIndexerConfig):
+    file_glob: Optional[List[str]] = Field(
+        default=None, description="Only index files whose path relative to input_path matches one of these globs")
+    exclude_glob: Optional[List[str]] = Field(
+        default=None, description="Skip files whose path relative to input_path matches one of these globs")
+
+
+@dataclass
+class ScanningLocalIndexer(LocalIndexer):
+    """
+    Local indexer that walks the input path with os.scandir and filters files
+    with include and exclude globs. scandir tells files from directories using
+    the directory listing, so walking takes no stat per entry, and excluded
+    files are dropped before any FileData is built. Each indexed file is still
+    stat'ed once, by LocalIndexer, for its metadata.
+
+    Files are never copied: the local downloader hands the source path to the
+    partitioner, which reads it in place.
+    """
+    index_config: ScanningLocalIndexerConfig
+
+    def _scan(self, root: Path) -> Generator[os.DirEntry, None, None]:
+        pending = [str(root)]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.index_config.recursive:
+                            pending.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+
+    def _matches(self, rel_path: str) -> bool:
+        include = self.index_config.file_glob
+        exclude = self.index_config.exclude_glob
+        if include and not any(fnmatch(rel_path, pattern) for pattern in include):
+            return False
+        return not (exclude and any(fnmatch(rel_path, pattern) for pattern in exclude))
+
+    def list_files(self) -> List[Path]:
+        input_path = self.index_config.path
+        if input_path.is_file():
+            return super().list_files()
+        return [
+            Path(entry.path) for entry in self._scan(input_path)
+            if self._matches(os.path.relpath(entry.path, input_path))
+        ]
@@ -7,6 +7,7 @@ from time import time, sleep
 from typing import TYPE_CHECKING, Any, Generator, Optional, List
 import hashlib
 import copy
+from collections import Counter
 
 from pydantic import Field, Secret
 
@@ -39,14 +40,38 @@ from unstructured_ingest.v2.processes.connector_registry import (
 from unstructured_ingest.v2.processes.connectors.mongodb import mongodb_destination_entry
 
 from pymongo import MongoClient
-from pymongo.operations import SearchIndexModel, DeleteMany, InsertOne
+from pymongo.operations import SearchIndexModel, DeleteMany, InsertOne, UpdateOne
 from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
 
 from tqdm import tqdm
 
+from util.artifacts import ARTIFACT_SUFFIX, load_elements, write_artifact
+from util.profiling import profile_allocations
+
 CONNECTOR_TYPE = "mongodb"
 SERVER_API_VERSION = "1"
 
+# Element metadata describing the file rather than the chunk. Fields with the
+# same value on every chunk of a file are moved to the file's document.
+FILE_METADATA_FIELDS = [
+    "data_source",
+    "file_directory",
+    "filename",
+    "filetype",
+    "languages",
+    "last_modified",
+]
+
+# What a chunk's content id is hashed from. Element ids, parent ids and
+# orig_elements depend on the chunk's position or the time it was processed.
+CHUNK_CONTENT_FIELDS = [
+    "text",
+    "type",
+    "metadata.page_number",
+    "metadata.text_as_html",
+]
+
 
 class MongoDBAccessConfig(AccessConfig):
     uri: Optional[str] = Field(
@@ -79,11 +104,31 @@ class MongoDBConnectionConfig(ConnectionConfig):
         default=None, description="Fields to be used to create the document ID")
     create_md5: Optional[bool] = Field(
         default=False, description="Whether to create an MD5 hash of the document")
+    chunk_fields: Optional[List[str]] = Field(
+        default=None, description="Dotted paths of the fields kept on chunk documents, all fields if unset")
+    files_collection: Optional[str] = Field(
+        default=None, description="Collection of per-file metadata documents that chunks reference by file_id, "
+                                  "unset to keep the metadata on every chunk")
+    diff_writes: Optional[bool] = Field(
+        default=False, description="Whether a file's chunks are diffed by content against the stored ones, "
+                                   "writing only added and changed chunks and deleting removed ones")
+    shadow_collection: Optional[str] = Field(
+        default=None, description="Collection a backfill inserts into, swapped in for the collection "
+                                  "once the backfill completes")
+    source_key: Optional[str] = Field(
+        default=None, description="Key of the registered source, stored on its chunk documents")
+    embedder_identity: Optional[str] = Field(
+        default=None, description="Settings that determine the embeddings, part of the content ids "
+                                  "so that switching embedders rewrites every chunk")
+    shadow_files_collection: Optional[str] = Field(
+        default=None, description="Collection a backfill writes per-file metadata documents into, "
+                                  "swapped in for files_collection along with the shadow collection")
 
 
 
 class MongoDBUploadStagerConfig(UploadStagerConfig):
-    pass
+    artifact_format: str = Field(
+        default="json", description="json, or zstd for compressed files with the embeddings packed as a binary matrix")
 
 
 class MongoDBIndexerConfig(IndexerConfig):
@@ -306,7 +351,10 @@ class MongoDBUploadStager(UploadStager):
     upload_stager_config: MongoDBUploadStagerConfig = field(
         default_factory=lambda: MongoDBUploadStagerConfig()
     )
+    # Set on the copy of the stager used by a profiled run
+    profile_dir: Optional[str] = None
 
+    @profile_allocations("stager")
     def run(
         self,
         elements_filepath: Path,
@@ -318,6 +366,8 @@ class MongoDBUploadStager(UploadStager):
         with open(elements_filepath) as elements_file:
             elements_contents = json.load(elements_file)
 
+        if self.upload_stager_config.artifact_format == "zstd":
+            return write_artifact(elements_contents, Path(output_dir) / f"{output_filename}{ARTIFACT_SUFFIX}")
         output_path = Path(output_dir) / Path(f"{output_filename}.json")
         with open(output_path, "w") as output_file:
             json.dump(elements_contents, output_file)
@@ -327,6 +377,10 @@ class MongoDBUploadStager(UploadStager):
 class MongoDBUploaderConfig(UploaderConfig):
     batch_size: int = Field(
         default=100, description="Number of records per batch")
+    backfill_batch_size: int = Field(
+        default=5000, description="Number of records per unordered insert into a shadow collection")
+    search_index_timeout: float = Field(
+        default=3600.0, description="Seconds to wait for a search index to become queryable")
 
 
 
@@ -335,6 +389,8 @@ class MongoDBUploader(Uploader):
     upload_config: MongoDBUploaderConfig
     connection_config: MongoDBConnectionConfig
     connector_type: str = CONNECTOR_TYPE
+    # Set on the copy of the uploader used by a profiled run
+    profile_dir: Optional[str] = None
 
     def precheck(self) -> None:
         try:
@@ -373,8 +429,7 @@ class MongoDBUploader(Uploader):
             )
 
     def run(self, path: Path, file_data: FileData, **kwargs: Any) -> None:
-        with path.open("r") as file:
-            elements_dict = json.load(file)
+        elements_dict = load_elements(path)
         logger.info(
             "writing %d objects to destination db, %s, collection %s at %s",
             len(elements_dict),
@@ -428,17 +483,100 @@ class MAAPUploader(MongoDBUploader):
             logger.info("Creating search index ...")
             search_index_model = self._get_search_index_model()
             collection.create_search_index(search_index_model)
-            while True:
-                idx = self._get_index_config(collection, index_name)
-                if idx and idx["queryable"]:
-                    print("Search index created successfully.")
-                    break
-                else:
-                    print("Waiting for search index to be created ...")
-                    sleep(5)
+            self._wait_for_search_index(collection, index_name)
         else:
             logger.info("Search index already exists.")
 
+    def _wait_for_search_index(self, collection, index_name):
+        """Wait for a search index to become queryable, raising if its build failed or timed out."""
+        timeout = self.upload_config.search_index_timeout
+        deadline = time() + timeout
+        while True:
+            idx = self._get_index_config(collection, index_name)
+            if idx and idx.get("status") == "FAILED":
+                raise RuntimeError(f"Search index {index_name} on {collection.name} failed to build")
+            if idx and idx["queryable"]:
+                print("Search index created successfully.")
+                break
+            elif time() > deadline:
+                raise TimeoutError(f"Search index {index_name} on {collection.name} "
+                                   f"is not queryable after {timeout:.0f}s")
+            else:
+                print("Waiting for search index to be created ...")
+                sleep(5)
+
+    def prepare_shadow(self) -> None:
+        """Drop what an earlier, unfinished backfill left in the shadow collections."""
+        db = self.create_client()[self.connection_config.database]
+        db.drop_collection(self.connection_config.shadow_collection)
+        if self.connection_config.shadow_files_collection:
+            db.drop_collection(self.connection_config.shadow_files_collection)
+
+    def _copy_indexes(self, db, name: str, shadow_name: str) -> bool:
+        """Create a collection's secondary indexes on its shadow, returns whether the collection exists."""
+        if shadow_name not in db.list_collection_names():
+            # Nothing was uploaded, the source is empty
+            db.create_collection(shadow_name)
+        if name not in db.list_collection_names():
+            return False
+        for index_name, info in db[name].index_information().items():
+            if index_name == "_id_":
+                continue
+            keys = info.pop("key")
+            info.pop("v", None)
+            info.pop("ns", None)
+            db[shadow_name].create_index(keys, name=index_name, **info)
+        return True
+
+    def swap_in_shadow(self) -> None:
+        """
+        Index the backfilled shadow collection and rename it over the collection.
+        Readers see the previous contents until the rename, which is atomic.
+        The files collection is swapped in just before, its document ids
+        don't change between loads.
+        """
+        client = self.create_client()
+        db = client[self.connection_config.database]
+        name, shadow_name = self.connection_config.collection, self.connection_config.shadow_collection
+        live, shadow = db[name], db[shadow_name]
+        # Secondary and search indexes are built once, over all documents
+        exists = self._copy_indexes(db, name, shadow_name)
+        shadow.create_index("doc_id")
+        search_indexes = [
+            SearchIndexModel(definition=idx["latestDefinition"], name=idx["name"], type=idx.get("type"))
+            for idx in (live.list_search_indexes() if exists else [])
+        ]
+        if not any(idx.document["name"] == self.connection_config.index_name for idx in search_indexes):
+            search_indexes.append(self._get_search_index_model())
+        logger.info(f"Building {len(search_indexes)} search indexes on {shadow_name}")
+        shadow.create_search_indexes(search_indexes)
+        # A failed or stuck index build raises here, before the live collection is touched
+        for idx in search_indexes:
+            self._wait_for_search_index(shadow, idx.document["name"])
+        files_name = self.connection_config.files_collection
+        shadow_files_name = self.connection_config.shadow_files_collection
+        if shadow_files_name:
+            self._copy_indexes(db, files_name, shadow_files_name)
+            client.admin.command(
+                "renameCollection", f"{db.name}.{shadow_files_name}", to=f"{db.name}.{files_name}",
+                dropTarget=True)
+        client.admin.command(
+            "renameCollection", f"{db.name}.{shadow_name}", to=f"{db.name}.{name}", dropTarget=True)
+        logger.info(f"Swapped backfilled {shadow_name} in for {name}")
+
+    def _backfill(self, elements: List[dict], file_data: FileData, db) -> None:
+        """Insert-only write into the shadow collection, which has no indexes to maintain yet."""
+        collection = db[self.connection_config.shadow_collection]
+        # Stable ids turn a retried file's inserts into duplicate key errors
+        for doc, chunk_id in zip(elements, self._chunk_ids(elements, self._file_id(file_data))):
+            doc["_id"] = chunk_id
+        for chunk in batch_generator(elements, self.upload_config.backfill_batch_size):
+            try:
+                collection.insert_many(chunk, ordered=False)
+            except BulkWriteError as e:
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+
     def _create_id_from_doc(self, doc: dict, fields: list, create_md5: bool = False) -> str:
         all_field_vals = [
             str(self._get_nested_value(doc, field)) for field in fields if self._get_nested_value(doc, field)
@@ -456,10 +594,131 @@ class MAAPUploader(MongoDBUploader):
                 return None
         return doc
 
-
+    def _project(self, doc: dict, field_paths: List[str]) -> dict:
+        projected = {}
+        for field_path in field_paths:
+            value = self._get_nested_value(doc, field_path)
+            if value is None:
+                continue
+            *parents, name = field_path.split(".")
+            target = projected
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[name] = value
+        return projected
+
+    def _file_id(self, file_data: FileData) -> str:
+        return hashlib.md5(file_data.identifier.encode()).hexdigest()
+
+    def _chunk_ids(self, elements: List[dict], file_id: str) -> List[str]:
+        """
+        Ids of a file's chunks, from a hash of their CHUNK_CONTENT_FIELDS, the
+        embedder and the projection. A new embedder or projection changes
+        every id, so every chunk is rewritten. Identical chunks are numbered
+        in order.
+        """
+        settings = [self.connection_config.embedder_identity, self.connection_config.chunk_fields]
+        occurrences = Counter()
+        ids = []
+        for doc in elements:
+            content = [self._get_nested_value(doc, field_path) for field_path in CHUNK_CONTENT_FIELDS]
+            digest = hashlib.sha1(json.dumps([content, settings], sort_keys=True, default=str).encode()).hexdigest()
+            ids.append(f"{file_id}-{digest}-{occurrences[digest]}")
+            occurrences[digest] += 1
+        return ids
+
+    def _extract_file_doc(self, elements: List[dict], file_data: FileData) -> dict:
+        """Move the metadata shared by every chunk of the file into the file's document."""
+        file_id = self._file_id(file_data)
+        file_doc = {"_id": file_id, "record_id": file_data.identifier}
+        metadatas = [doc.get("metadata") or {} for doc in elements]
+        for name in FILE_METADATA_FIELDS:
+            values = [metadata.get(name) for metadata in metadatas]
+            if values and values[0] is not None and all(value == values[0] for value in values):
+                file_doc[name] = values[0]
+                for metadata in metadatas:
+                    metadata.pop(name, None)
+        for doc in elements:
+            doc["file_id"] = file_id
+        return file_doc
+
+    def _normalize(self, elements: List[dict], file_data: FileData, db) -> List[dict]:
+        """Project chunk documents and split off per-file metadata, after doc ids were computed."""
+        if self.connection_config.files_collection and elements:
+            file_doc = self._extract_file_doc(elements, file_data)
+            files_collection = (self.connection_config.shadow_files_collection
+                                or self.connection_config.files_collection)
+            db[files_collection].replace_one(
+                {"_id": file_doc["_id"]}, file_doc, upsert=True)
+        chunk_fields = self.connection_config.chunk_fields
+        if not chunk_fields:
+            return elements
+        # The ids and the embedding are needed by updates and vector search
+        kept = [*chunk_fields, "doc_id", "file_id", "source_key", self.connection_config.embedding_path]
+        return [self._project(doc, kept) for doc in elements]
+
+
+    def _legacy_chunks_filter(self, file_data: FileData) -> Optional[dict]:
+        """
+        Chunks of a file that were written without content ids, found by the
+        file's record locator, or by its file id when normalize_metadata moved
+        the locator into the file's document. Chunks stamped with another
+        source's key are never matched. None if the file has no locator.
+        """
+        record_locator = file_data.metadata.record_locator
+        if not record_locator:
+            return None
+        locator = {f"metadata.data_source.record_locator.{key}": value for key, value in record_locator.items()}
+        return {
+            # Chunks written before sources were stamped on them have no source_key
+            "source_key": {"$in": [self.connection_config.source_key, None]},
+            "_id": {"$type": "objectId"},
+            "$or": [locator, {"file_id": self._file_id(file_data)}],
+        }
+
+    def _write_diff(self, collection, elements: List[dict], file_data: FileData) -> None:
+        """
+        Write only what changed in a file since it was last written: insert new
+        chunks, delete removed ones and update the file-level metadata of the
+        others, in one bulk write. Chunks are matched by their content ids.
+        """
+        file_id = self._file_id(file_data)
+        new = dict(zip(self._chunk_ids(elements, file_id), elements))
+        stored = {
+            doc["_id"]: doc.get("metadata") or {}
+            for doc in collection.find(
+                {"_id": {"$regex": f"^{file_id}-"}},
+                {f"metadata.{name}": 1 for name in FILE_METADATA_FIELDS},
+            )
+        }
+        operations = []
+        removed = [chunk_id for chunk_id in stored if chunk_id not in new]
+        if removed:
+            operations.append(DeleteMany({"_id": {"$in": removed}}))
+        elif not stored and self._legacy_chunks_filter(file_data):
+            # The file's chunks were written before diffing, without content ids
+            operations.append(DeleteMany(self._legacy_chunks_filter(file_data)))
+        added = 0
+        for chunk_id, doc in new.items():
+            if chunk_id not in stored:
+                operations.append(InsertOne({"_id": chunk_id, **doc}))
+                added += 1
+                continue
+            changed = {
+                f"metadata.{name}": value for name, value in (doc.get("metadata") or {}).items()
+                if name in FILE_METADATA_FIELDS and stored[chunk_id].get(name) != value
+            }
+            if changed:
+                operations.append(UpdateOne({"_id": chunk_id}, {"$set": changed}))
+        logger.info(f"{file_data.identifier}: {added} chunks added, {len(removed)} removed, "
+                    f"{len(new) - added} unchanged")
+        if operations:
+            # Ordered, so chunks are deleted before their replacements are inserted
+            collection.bulk_write(operations, ordered=True)
+
+    @profile_allocations("uploader")
     def run(self, path: Path, file_data: FileData, **kwargs: Any) -> None:
-        with path.open("r") as file:
-            elements_dict = json.load(file)
+        elements_dict = load_elements(path)
         logger.info(
             "writing %d objects to destination db, %s, collection %s at %s",
             len(elements_dict),
@@ -474,6 +733,16 @@ class MAAPUploader(MongoDBUploader):
         for doc in elements:
             doc["doc_id"] = self._create_id_from_doc(
                 doc, self.connection_config.id_fields, self.connection_config.create_md5)
+            if self.connection_config.source_key:
+                doc["source_key"] = self.connection_config.source_key
+        elements = self._normalize(elements, file_data, db)
+        if self.connection_config.shadow_collection:
+            self._backfill(elements, file_data, db)
+            return
+        if self.connection_config.diff_writes:
+            self._write_diff(collection, elements, file_data)
+            self._check_n_create_index()
+            return
         ids = set(map(lambda x: x["doc_id"], elements_dict))
         ids = filter(lambda x: collection.find_one({"doc_id": x}), ids)
         print(ids)
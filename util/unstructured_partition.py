@@ -0,0 +1,360 @@
+import asyncio
+import io
+import json
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from pydantic import Field
+
+from unstructured_ingest.utils.dep_check import requires_dependencies
+from unstructured_ingest.v2.interfaces import FileData
+from unstructured_ingest.v2.logger import logger
+from unstructured_ingest.v2.pipeline.steps.partition import PartitionStep, PartitionStepResponse
+from unstructured_ingest.v2.processes.partitioner import Partitioner, PartitionerConfig
+
+
+PARTITION_PATH = "/general/v0/general"
+
+
+def partition_url(endpoint: str) -> str:
+    """
+    URL partition requests are posted to. Like the unstructured client, only the
+    endpoint's scheme and host are kept, so base API URLs work as well as full
+    endpoint URLs.
+    """
+    if "://" not in endpoint:
+        endpoint = f"{'http' if endpoint.startswith('localhost') else 'https'}://{endpoint}"
+    parsed = urlparse(endpoint)
+    return f"{parsed.scheme}://{parsed.netloc}{PARTITION_PATH}"
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Bounds the number of requests in flight. The bound grows by one per window of
+    requests that succeed under the target latency and halves when a request is
+    throttled, fails with a server error or is slower than the target. Requests
+    that started before the last decrease don't decrease it again, so a burst of
+    failures halves it once.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, target_latency: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """Wait for room under the current bound, yielding the request's start time."""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield time.monotonic()
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record(self, started: float, ok: bool) -> None:
+        latency = time.monotonic() - started
+        with self._condition:
+            if ok and latency <= self.target_latency:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif started >= self._last_decrease:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._last_decrease = time.monotonic()
+                reason = f"latency {latency:.1f}s" if ok else "request failed"
+                logger.info(f"partition API concurrency lowered to {int(self.limit)} ({reason})")
+            self._condition.notify_all()
+
+
+class PooledPartitionerConfig(PartitionerConfig):
+    initial_concurrency: int = Field(
+        default=4, description="Number of partition API requests in flight to start with")
+    max_concurrency: int = Field(
+        default=16, description="Upper bound on partition API requests in flight")
+    target_latency: float = Field(
+        default=120.0, description="Request latency in seconds above which concurrency is lowered")
+    max_retries: int = Field(
+        default=5, description="Retries with exponential backoff on throttling, server and connection errors")
+    request_timeout: float = Field(
+        default=600.0, description="Timeout in seconds of a single partition API request")
+    pdf_page_batch_size: int = Field(
+        default=20, description="PDFs with more pages are sent as concurrent batches of this many pages, 0 disables")
+
+
+@dataclass
+class PooledPartitioner(Partitioner):
+    """
+    Partitioner for the hosted API that sends files over one pooled HTTP session,
+    adapts the number of requests in flight to the measured latency and error
+    rate, retries throttled and failed requests, and splits large PDFs into page
+    batches partitioned concurrently.
+    """
+    config: PooledPartitionerConfig
+    _session: Any = field(default=None, init=False, repr=False)
+    _limiter: Optional[AdaptiveConcurrencyLimiter] = field(default=None, init=False, repr=False)
+    _executor: Optional[ThreadPoolExecutor] = field(default=None, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def _get_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config.max_concurrency)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if self.config.api_key:
+                    session.headers["unstructured-api-key"] = self.config.api_key.get_secret_value()
+                session.headers["accept"] = "application/json"
+                self._session = session
+                self._limiter = AdaptiveConcurrencyLimiter(
+                    initial=self.config.initial_concurrency,
+                    minimum=1,
+                    maximum=self.config.max_concurrency,
+                    target_latency=self.config.target_latency,
+                )
+            return self._session
+
+    def _form_fields(self) -> List[Tuple[str, str]]:
+        form = []
+        for key, value in self.config.to_partition_kwargs().items():
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, (bool, dict)):
+                    item = json.dumps(item)
+                form.append((key, str(item)))
+        return form
+
+    def _post(self, file_name: str, content: bytes, starting_page_number: int = 1) -> List[Dict[str, Any]]:
+        import requests
+
+        session = self._get_session()
+        url = partition_url(self.config.partition_endpoint)
+        form = self._form_fields()
+        if starting_page_number > 1:
+            form.append(("starting_page_number", str(starting_page_number)))
+        for attempt in range(self.config.max_retries + 1):
+            response, error = None, None
+            with self._limiter.slot() as started:
+                try:
+                    response = session.post(
+                        url,
+                        files={"files": (file_name, content)},
+                        data=form,
+                        timeout=self.config.request_timeout,
+                    )
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+            retryable = response is None or response.status_code == 429 or response.status_code >= 500
+            self._limiter.record(started, ok=not retryable)
+            if not retryable:
+                response.raise_for_status()
+                return response.json()
+            if attempt == self.config.max_retries:
+                if error:
+                    raise error
+                response.raise_for_status()
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+            logger.warning(f"partition API request for {file_name} failed "
+                           f"({error or response.status_code}), retrying in {delay:.0f}s")
+            time.sleep(delay + random.uniform(0, 1))
+
+    @requires_dependencies(["pypdf"])
+    def _pdf_page_batches(self, filename: Path) -> Optional[List[Tuple[int, bytes]]]:
+        """Split a PDF into batches of pages, or None if it fits in one request."""
+        from pypdf import PdfReader, PdfWriter
+
+        batch_size = self.config.pdf_page_batch_size
+        reader = PdfReader(filename)
+        num_pages = len(reader.pages)
+        if num_pages <= batch_size:
+            return None
+        batches = []
+        for start in range(0, num_pages, batch_size):
+            writer = PdfWriter()
+            for page in reader.pages[start:start + batch_size]:
+                writer.add_page(page)
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            batches.append((start + 1, buffer.getvalue()))
+        return batches
+
+    def partition_via_pool(self, filename: Path, metadata: Optional[dict] = None) -> List[dict]:
+        metadata = metadata or {}
+        logger.debug(f"partitioning file {filename} with metadata: {metadata}")
+        batches = None
+        if self.config.pdf_page_batch_size > 0 and filename.suffix.lower() == ".pdf":
+            batches = self._pdf_page_batches(filename)
+        if batches:
+            logger.debug(f"sending {filename} as {len(batches)} page batches")
+            with ThreadPoolExecutor(max_workers=self.config.max_concurrency) as pool:
+                # map keeps the batches, and so the elements, in page order
+                results = pool.map(
+                    lambda batch: self._post(filename.name, batch[1], starting_page_number=batch[0]),
+                    batches,
+                )
+                elements = [element for result in results for element in result]
+        else:
+            elements = self._post(filename.name, filename.read_bytes())
+
+        # Append the data source metadata the auto partition does for you
+        for element in elements:
+            element["metadata"]["data_source"] = metadata
+        return self.postprocess(elements=elements)
+
+    async def run_async(
+        self, filename: Path, metadata: Optional[dict] = None, **kwargs
+    ) -> List[dict]:
+        # Requests block in a thread pool sized to the concurrency bound, the
+        # limiter decides how many of them are in flight
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.config.max_concurrency)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self.partition_via_pool(filename, metadata=metadata))
+
+
+class PageRangePartitionerConfig(PartitionerConfig):
+    pdf_page_range_size: int = Field(
+        default=50, description="PDFs with more pages are partitioned in ranges of this many pages in parallel, 0 disables")
+
+
+@dataclass
+class PageRangePartitioner(Partitioner):
+    """Local partitioner that can partition a range of pages of a PDF on its own."""
+    config: PageRangePartitionerConfig
+
+    @requires_dependencies(["pypdf"])
+    def page_ranges(self, filename: Path) -> Optional[List[Tuple[int, int]]]:
+        """First and last page, 1-based, of each range of a PDF, or None if it is partitioned whole."""
+        from pypdf import PdfReader
+
+        range_size = self.config.pdf_page_range_size
+        if range_size <= 0 or filename.suffix.lower() != ".pdf":
+            return None
+        num_pages = len(PdfReader(filename).pages)
+        if num_pages <= range_size:
+            return None
+        return [(start, min(start + range_size - 1, num_pages)) for start in range(1, num_pages + 1, range_size)]
+
+    @requires_dependencies(["unstructured", "pypdf"])
+    def partition_page_range(
+        self, filename: Path, first_page: int, last_page: int, metadata: Optional[dict] = None
+    ) -> List[dict]:
+        from pypdf import PdfReader, PdfWriter
+        from unstructured.documents.elements import DataSourceMetadata
+        from unstructured.partition.auto import partition
+        from unstructured.partition.common import get_last_modified_date
+        from unstructured.staging.base import elements_to_dicts
+
+        @dataclass
+        class FileDataSourceMetadata(DataSourceMetadata):
+            filesize_bytes: Optional[int] = None
+
+        reader = PdfReader(filename)
+        writer = PdfWriter()
+        for page in reader.pages[first_page - 1:last_page]:
+            writer.add_page(page)
+        logger.debug(f"partitioning pages {first_page}-{last_page} of {filename}")
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pages_file:
+            writer.write(pages_file)
+            pages_file.flush()
+            elements = partition(
+                filename=pages_file.name,
+                data_source_metadata=FileDataSourceMetadata.from_dict(metadata),
+                # Elements carry the source file, its modification time and their page numbers in it,
+                # rather than the temporary range file's
+                metadata_filename=str(filename.resolve()),
+                metadata_last_modified=get_last_modified_date(str(filename)),
+                starting_page_number=first_page,
+                **self.config.to_partition_kwargs(),
+            )
+        return self.postprocess(elements=elements_to_dicts(elements))
+
+
+@dataclass
+class PageRangePartitionStep(PartitionStep):
+    """
+    Partition step that splits large PDFs into page ranges, partitions the ranges
+    across the process pool along with the other files, and merges each PDF's
+    ranges back in page order. Ranges are queued first so a long PDF no longer
+    keeps one worker busy after the others are done.
+    """
+    process: PageRangePartitioner
+
+    def _page_ranges(self, item: dict) -> Optional[List[Tuple[int, int]]]:
+        file_data = FileData.from_file(path=item["file_data_path"])
+        output_filepath = self.get_output_filepath(filename=Path(item["file_data_path"]))
+        if not self.should_partition(filepath=output_filepath, file_data=file_data):
+            return None
+        try:
+            return self.process.page_ranges(Path(item["path"]))
+        except Exception as e:
+            logger.warning(f"partitioning {item['path']} whole, could not split it into page ranges: {e}")
+            return None
+
+    def process_multiprocess(self, iterable: List[dict]) -> Any:
+        ranged = {}
+        units = []
+        for item in iterable:
+            ranges = self._page_ranges(item)
+            if ranges:
+                ranged[item["file_data_path"]] = ranges
+                units.extend({**item, "page_range": page_range} for page_range in ranges)
+        units.extend(item for item in iterable if item["file_data_path"] not in ranged)
+
+        results = super().process_multiprocess(units)
+        responses = [r for r in results if r and "page_range" not in r]
+        parts = defaultdict(list)
+        for r in results:
+            if r and "page_range" in r:
+                parts[r["file_data_path"]].append(r)
+        for file_data_path, ranges in ranged.items():
+            if len(parts[file_data_path]) != len(ranges):
+                # A failed range already recorded the file's error in the run status
+                continue
+            responses.append(self._merge(file_data_path, parts[file_data_path]))
+        return responses
+
+    def _merge(self, file_data_path: str, parts: List[dict]) -> PartitionStepResponse:
+        elements = []
+        for part in sorted(parts, key=lambda part: part["page_range"][0]):
+            with open(part["path"]) as f:
+                elements.extend(json.load(f))
+            Path(part["path"]).unlink()
+        output_filepath = self.get_output_filepath(filename=Path(file_data_path))
+        self._save_output(output_filepath=str(output_filepath), partitioned_content=elements)
+        return PartitionStepResponse(file_data_path=file_data_path, path=str(output_filepath))
+
+    async def _run_async(
+        self, fn: Any, path: str, file_data_path: str, page_range: Optional[Tuple[int, int]] = None
+    ) -> Optional[dict]:
+        if page_range is None:
+            return await super()._run_async(fn=fn, path=path, file_data_path=file_data_path)
+        first_page, last_page = page_range
+        file_data = FileData.from_file(path=file_data_path)
+        output_filepath = self.get_output_filepath(filename=Path(file_data_path)).with_suffix(
+            f".pages-{first_page}-{last_page}.json")
+        if self.should_partition(filepath=output_filepath, file_data=file_data):
+            elements = self.process.partition_page_range(
+                Path(path), first_page, last_page, metadata=file_data.metadata.to_dict())
+            self._save_output(output_filepath=str(output_filepath), partitioned_content=elements)
+        return {"file_data_path": file_data_path, "path": str(output_filepath), "page_range": page_range}
@@ -0,0 +1,119 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from pydantic import Field
+
+from unstructured_ingest.error import SourceConnectionNetworkError
+from unstructured_ingest.v2.interfaces import DownloadResponse, FileData
+from unstructured_ingest.v2.logger import logger
+from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
+    S3Downloader,
+    S3DownloaderConfig,
+    S3Indexer,
+    S3IndexerConfig,
+)
+
+
+class ParallelS3IndexerConfig(S3IndexerConfig):
+    listing_concurrency: int = Field(
+        default=8, description="Number of prefixes listed concurrently")
+    shard_depth: int = Field(
+        default=1, description="Number of prefix levels to split a recursive listing across")
+
+
+class ParallelS3DownloaderConfig(S3DownloaderConfig):
+    download_concurrency: int = Field(
+        default=8, description="Number of files downloaded concurrently")
+    multipart_threshold: int = Field(
+        default=64 * 1024 * 1024, description="Size in bytes above which a file is downloaded in ranges")
+    part_size: int = Field(
+        default=8 * 1024 * 1024, description="Size in bytes of each ranged GET")
+    part_concurrency: int = Field(
+        default=8, description="Number of ranged GETs in flight per file")
+
+
+@dataclass
+class ParallelS3Indexer(S3Indexer):
+    """
+    S3 indexer that splits a recursive listing into one listing per sub-prefix,
+    down to shard_depth levels, and lists the shards concurrently.
+    """
+    index_config: ParallelS3IndexerConfig
+
+    def _list_shards(self, prefix: str, depth: int) -> List[Dict[str, Any]]:
+        if depth == 0:
+            return list(self.fs.find(prefix, detail=True).values())
+        # A delimited listing returns the files directly under the prefix and
+        # the sub-prefixes to shard on. fsspec reuses the filesystem, and with it
+        # the listings cached by earlier runs, so always ask S3.
+        entries = self.fs.ls(prefix, detail=True, refresh=True)
+        files = [entry for entry in entries if entry.get("type") == "file"]
+        sub_prefixes = [entry["name"] for entry in entries if entry.get("type") == "directory"]
+        with ThreadPoolExecutor(max_workers=self.index_config.listing_concurrency) as pool:
+            for shard in pool.map(lambda p: self._list_shards(p, depth - 1), sub_prefixes):
+                files.extend(shard)
+        return files
+
+    def get_file_data(self) -> List[Dict[str, Any]]:
+        if not self.index_config.recursive or self.index_config.shard_depth < 1:
+            return super().get_file_data()
+        files = self._list_shards(self.index_config.path_without_protocol, self.index_config.shard_depth)
+        logger.info(f"Listed {len(files)} objects under {self.index_config.remote_url}")
+        filtered_files = [
+            file for file in files if file.get("size") > 0 and file.get("type") == "file"
+        ]
+        if self.index_config.sample_n_files:
+            filtered_files = self.sample_n_files(filtered_files, self.index_config.sample_n_files)
+        return filtered_files
+
+
+@dataclass
+class ParallelS3Downloader(S3Downloader):
+    """
+    S3 downloader that runs downloads concurrently and fetches large objects as
+    concurrent ranged GETs written straight into place in the output file.
+    """
+    download_config: Optional[ParallelS3DownloaderConfig] = field(
+        default_factory=ParallelS3DownloaderConfig)
+    _executor: Optional[ThreadPoolExecutor] = field(default=None, init=False, repr=False)
+
+    def _download_ranges(self, rpath: str, size: int, download_path: Path) -> None:
+        part_size = self.download_config.part_size
+        fs = self.fs
+        with open(download_path, "wb") as f:
+            f.truncate(size)
+
+        def fetch(start: int) -> None:
+            data = fs.cat_file(rpath, start=start, end=min(start + part_size, size))
+            with open(download_path, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+
+        with ThreadPoolExecutor(max_workers=self.download_config.part_concurrency) as pool:
+            list(pool.map(fetch, range(0, size, part_size)))
+
+    def run(self, file_data: FileData, **kwargs: Any) -> DownloadResponse:
+        rpath = file_data.additional_metadata["original_file_path"]
+        size = file_data.metadata.filesize_bytes
+        if not size or int(size) < self.download_config.multipart_threshold:
+            return super().run(file_data=file_data, **kwargs)
+        download_path = self.get_download_path(file_data=file_data)
+        download_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self._download_ranges(rpath, int(size), download_path)
+        except Exception as e:
+            logger.error(f"failed to download file {file_data.identifier}: {e}", exc_info=True)
+            raise SourceConnectionNetworkError(f"failed to download file {file_data.identifier}")
+        return self.generate_download_response(file_data=file_data, download_path=download_path)
+
+    async def run_async(self, file_data: FileData, **kwargs: Any) -> DownloadResponse:
+        # The inherited run_async calls the blocking run on the event loop, which
+        # serializes every download of the step
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.download_config.download_concurrency)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: self.run(file_data=file_data, **kwargs))
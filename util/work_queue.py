@@ -0,0 +1,156 @@
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+from pymongo import ReturnDocument
+from pymongo.collection import Collection
+
+
+@contextmanager
+def lease_heartbeat(renew: Callable[[], None], interval: float):
+    """Call ``renew`` every ``interval`` seconds until the block exits."""
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(interval):
+            renew()
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+class WorkQueue:
+    """
+    MongoDB backed queue of per-file tasks shared by all loader replicas.
+
+    A source run is indexed once and every indexed file becomes a task. Replicas
+    claim batches of tasks with a lease, run them from download through upload
+    and mark them done. Tasks whose lease expired are claimed again, and tasks
+    that keep failing, or keep taking their worker down, are marked failed
+    after MAX_ATTEMPTS. Only the worker holding a task's claim can complete,
+    release or renew it.
+    """
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    def create_indexes(self) -> None:
+        self.collection.create_index([("status", 1), ("lease_expires_at", 1)])
+        self.collection.create_index([("job_id", 1), ("run_id", 1), ("status", 1)])
+
+    def _lease_expiry(self) -> datetime:
+        return datetime.now() + timedelta(seconds=self.LEASE_SECONDS)
+
+    def enqueue(self, job_id: Any, run_id: str, file_datas: List[Dict[str, Any]]) -> None:
+        """Queue one task per indexed file of a source run."""
+        self.collection.insert_many([
+            {
+                "job_id": job_id,
+                "run_id": run_id,
+                "file_data": file_data,
+                "status": "pending",
+                "attempts": 0,
+            }
+            for file_data in file_datas
+        ], ordered=False)
+
+    def _claim_one(self, worker_id: str, query: Dict[str, Any]) -> Dict[str, Any]:
+        claimable = {"$or": [
+            {"status": "pending"},
+            {
+                "status": "claimed",
+                "lease_expires_at": {"$lt": datetime.now()},
+                "attempts": {"$lt": self.MAX_ATTEMPTS},
+            },
+        ]}
+        return self.collection.find_one_and_update(
+            {**query, **claimable},
+            {
+                "$set": {
+                    "status": "claimed",
+                    "worker_id": worker_id,
+                    "lease_expires_at": self._lease_expiry(),
+                },
+                "$inc": {"attempts": 1},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def claim(self, worker_id: str, batch_size: int) -> List[Dict[str, Any]]:
+        """Claim up to batch_size tasks, all belonging to the same source run."""
+        task = self._claim_one(worker_id, {})
+        if not task:
+            return []
+        tasks = [task]
+        same_run = {"job_id": task["job_id"], "run_id": task["run_id"]}
+        while len(tasks) < batch_size:
+            task = self._claim_one(worker_id, same_run)
+            if not task:
+                break
+            tasks.append(task)
+        return tasks
+
+    def _claimed_by(self, task_ids: List[Any], worker_id: str) -> Dict[str, Any]:
+        # A worker whose lease expired may no longer own its tasks
+        return {"_id": {"$in": task_ids}, "status": "claimed", "worker_id": worker_id}
+
+    def renew(self, task_ids: List[Any], worker_id: str) -> None:
+        self.collection.update_many(
+            self._claimed_by(task_ids, worker_id),
+            {"$set": {"lease_expires_at": self._lease_expiry()}},
+        )
+
+    @contextmanager
+    def hold_lease(self, task_ids: List[Any], worker_id: str):
+        """Keep renewing the lease of claimed tasks until the block exits."""
+        with lease_heartbeat(lambda: self.renew(task_ids, worker_id), self.LEASE_SECONDS / 3):
+            yield
+
+    def complete(self, task_ids: List[Any], worker_id: str) -> None:
+        self.collection.update_many(
+            self._claimed_by(task_ids, worker_id),
+            {"$set": {"status": "done"}, "$unset": {"lease_expires_at": ""}},
+        )
+
+    def release(self, task_ids: List[Any], worker_id: str, error: str) -> None:
+        """Return failed tasks to the queue, or fail them once out of attempts."""
+        self.collection.update_many(
+            {**self._claimed_by(task_ids, worker_id), "attempts": {"$gte": self.MAX_ATTEMPTS}},
+            {"$set": {"status": "failed", "error": error}, "$unset": {"lease_expires_at": ""}},
+        )
+        self.collection.update_many(
+            self._claimed_by(task_ids, worker_id),
+            {"$set": {"status": "pending", "error": error}, "$unset": {"lease_expires_at": ""}},
+        )
+
+    def fail_expired(self) -> None:
+        """Fail tasks whose last allowed attempt lost its lease, e.g. because the file crashed its worker."""
+        self.collection.update_many(
+            {
+                "status": "claimed",
+                "lease_expires_at": {"$lt": datetime.now()},
+                "attempts": {"$gte": self.MAX_ATTEMPTS},
+            },
+            {"$set": {"status": "failed", "error": "lease expired on the last attempt"},
+             "$unset": {"lease_expires_at": ""}},
+        )
+
+    def run_status(self, job_id: Any, run_id: str) -> Dict[str, int]:
+        """Count the tasks of a source run by status."""
+        counts = self.collection.aggregate([
+            {"$match": {"job_id": job_id, "run_id": run_id}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}},
+        ])
+        return {c["_id"]: c["count"] for c in counts}
+
+    def clear(self, job_id: Any) -> None:
+        """Drop every task of a job, e.g. before it is indexed again."""
+        self.collection.delete_many({"job_id": job_id})